@@ -5,6 +5,17 @@ from pathlib import Path
 import subprocess
 import time
 import numpy as np
+import pppp_cache
+from pppp_api import (average_intensity_files, cached_average_intensity, expand_files, intensity_table, prepare_files,
+                      write_intensity_job)
+from pppp_events import H5_DATASET, dataset_from_crystfel_geom
+from pppp_histogram import counts_filename, histogram_file
+from pppp_intensity import feature_config, pixel_config
+from pppp_jobs import SCHEDULERS, JobGraph, JobTracker, array_sentinels, get_scheduler, write_array_script
+from pppp_preview import FRACTION, preview, write_preview
+from pppp_threshold import print_suggestion, suggest_threshold
+from pppp_table import ResultsWriter, RunMerger, load_results, make_table, read_table, write_results
+from pppp_timing import Timeline, write_timing
 
 # ----------------------------------------------------------------------
 # pppp - X-ray Pump and Probe Processing Pipeline
@@ -16,85 +27,102 @@ import numpy as np
 # EXAMPLE USAGE
 # dials.python pppp.py --dir /path/to/cheetah/ --files 133451 --geom /path/to/refined.expt --geom_crystfel /path/to/geometry1.geom
 # dials.python pppp.py --dir /path/to/cheetah/ --files 133451-0 133451-1 133451-2 --geom /path/to/refined.expt
+# dials.python pppp.py --dir /path/to/cheetah/ --files 133451 --geom /path/to/refined.expt --local 16
+# dials.python pppp.py --dir /path/to/cheetah/ --files 133451 --geom /path/to/refined.expt --stride 10
 # ----------------------------------------------------------------------
 #
 # Dependencies: qsub and Python3 (e.g. dials.python) on GNU/Linux
 #
-# After run, results are available in files average_intensity_all.csv and average_intensity_all.png
+# After run, results are available in files average_intensity_all.npy (average_intensity_all.csv)
+# and average_intensity_all.png
+# and images are listed in events.lst for CrystFEL
+# Timings of stages and jobs are saved in pppp_timing.json and pppp_trace.json
+# (the trace can be opened in chrome://tracing or https://ui.perfetto.dev)
 #
 #
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-#            IMPORTANT SETTING - PATHS TO DIALS AND CRYSTFEL
+#            IMPORTANT SETTING - PATH TO DIALS
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 SOURCE_DIALS = "module load dials/nightly"
 # SOURCE_DIALS = ""
-SOURCE_CRYSTFEL = "module load crystfel"
-# SOURCE_CRYSTFEL = ""
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
+# average intensity engine executed by the jobs
+PPPP_INTENSITY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pppp_intensity.py")
 
-# https://stackoverflow.com/questions/2785821/is-there-an-easy-way-in-python-to-wait-until-certain-condition-is-true
-def wait_until_not_empty(filename, period=5):
-    while True:
-        if os.path.exists(filename):
-            if os.stat(filename).st_size != 0: return True
-        #print("Still waiting...")
-        time.sleep(period)
-    return False
 
+def plot_histogram(inputfile='average_intensity_all.npy', outputplot='average_intensity_all.png'):
+    """Histogram of average intensities from 0 to 100, counts are saved in
+    average_intensity_all_histogram.csv"""
+    print("Plotting the result...")
+    histogram = histogram_file(inputfile, maximum=100, n_bins=200)
+    print(f"Counts of the histogram saved in {histogram.write(counts_filename(outputplot))}")
+    if not histogram.plot(outputplot):
+        return None
+    print(f"Histogram plotted to {outputplot}")
+    return outputplot
 
-def wait_until_qjob_finished(job_id, period=5):
-    first_cycle = True
-    while True:
-        p = subprocess.Popen(
-            ['qstat', '-j', str(job_id)],# stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            encoding="utf-8")  # shell=settings["sh"])
-        output, err = p.communicate()
-        if "Following jobs do not exist or permissions are not sufficient:" in str(output) or "Following jobs do not exist or permissions are not sufficient:" in str(err):
-            print("")
-            print("Job finished: " + str(job_id))
-            return True
-        if first_cycle:
-            print("")
-            print("Still waiting for job  " + str(job_id), end="")
-            first_cycle = False
-        else:
-            print(".", end="")
-        time.sleep(period)
-    return False
 
+def merge_average_intensity(files, sim=False, directory=".", ready=None):
+    """Merge average_intensity.npy of all files to average_intensity_all.npy, export
+    average_intensity_all.csv and plot a histogram - all in directory.
+    ready - (file, True) in the order their results become available, e.g. as
+    jobs finish, (file, False) for files left out as their jobs failed
+    (default: all are available now)"""
+    def stem(f):
+        return os.path.normpath(os.path.join(directory, f, "average_intensity"))
+    if sim:
+        for f in files:
+            write_results(stem(f), make_table(f, [], []))
+    # streamed in the order of (run, event), a file is appended as soon as
+    # all earlier files are, only a chunk of a file in memory
+    with ResultsWriter(os.path.normpath(os.path.join(directory, "average_intensity_all"))) as writer:
+        merger = RunMerger(writer, files)
+        for f, available in ready or []:
+            if available:
+                merger.add(f, load_results(stem(f)))
+            else:
+                merger.skip(f)
+        for f in merger.missing():
+            merger.add(f, load_results(stem(f)))
+        merged = writer.filename
+    print("Check data in the file average_intensity_all.csv")
+    print("You can use it to plot a histogram.")
 
-def plot_histogram(inputfile='average_intensity_all.csv', outputplot='average_intensity_all.png'):
-    try:
-        import numpy as np
-        import matplotlib.pyplot as plt
-        from pandas import read_csv
-    except:
-        print(f"Histogram not plotted. An error ocurred while importing numpy, matplotlib.pyplot or pandas.")
-        return None
+    outputplot = plot_histogram(inputfile=os.path.normpath(os.path.join(directory, 'average_intensity_all.npy')),
+                                outputplot=os.path.normpath(os.path.join(directory, 'average_intensity_all.png')))
 
-    print("Plotting the result...")
-    df = read_csv(inputfile, header=None, index_col=False, sep=',',
-                  names=("runevent", "average_intensity"))
-    x = df["average_intensity"].to_numpy()
-    n_images = x.size
-    maximal_intensity = 100
-    n_histogram_bins = 2 * maximal_intensity
-    n_labels = maximal_intensity / 10
-    n, bins, patches = plt.hist(x, n_histogram_bins, density=True, facecolor='g', alpha=0.75)
-    plt.xlim([0, maximal_intensity])
-    n_images = x.size
-    plt.locator_params(nbins=n_labels, axis='x')
-    plt.xlabel('Average total scattered intensity')
-    plt.grid(True)
-    plt.title('Number of images used: ' + str(n_images))
-    plt.savefig(outputplot, bbox_inches="tight", dpi=200)
-    plt.title('Number of images used: ' + str(n_images))
-    print(f"Histogram plotted to {outputplot}")
+    if not sim:
+        try:
+            print_suggestion(suggest_threshold(read_table(merged)["intensity"]))
+            print("Use '--threshold auto' in pppp2.py to split the images accordingly.")
+        except ValueError as e:
+            print(f"Threshold not suggested: {e}")
     return outputplot
 
 
+def completed_files(tracker, files, todo_files):
+    """(file, True) for files with results already and then for files of jobs
+    (task i - todo_files[i - 1]) as they finish, (file, False) for files of
+    failed tasks"""
+    reported = set()
+    def failed_files():
+        # tasks failed since the last check
+        for job_id, task in list(tracker.failed):
+            if (job_id, task) not in reported:
+                reported.add((job_id, task))
+                print(f"WARNING: Average intensity not calculated: {todo_files[task - 1]} - left out of the merge")
+                yield todo_files[task - 1], False
+
+    yield from ((f, True) for f in files if f not in todo_files)
+    for job_id, task in tracker.as_completed():
+        yield from failed_files()
+        print("")
+        print(f"Average intensity calculated: {todo_files[task - 1]}")
+        yield todo_files[task - 1], True
+    yield from failed_files()
+
+
 def run():
     parser = argparse.ArgumentParser(
         description="pppp - X-ray Pump and Probe Processing Pipeline - 1st script - calculate average total scattered intensity"
@@ -121,7 +149,86 @@ def run():
     )
     parser.add_argument(
         "--geom_crystfel",
-        help="Absolute path to a geometry file for CrystFEL",
+        help="Absolute path to a geometry file for CrystFEL - used to find the dataset with images",
+        type=str,
+    )
+    parser.add_argument(
+        "--local",
+        help="Calculate the average intensity on this computer using N processes instead of qsub jobs",
+        type=int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--scheduler",
+        help="Batch system used to execute jobs (default: qsub)",
+        choices=sorted(SCHEDULERS),
+        default="qsub",
+    )
+    parser.add_argument(
+        "--detach",
+        help="Do not wait for the jobs - merging of the results is submitted as a job depending on them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--preview",
+        help=f"Only estimate the histogram and threshold from a sample of images - starting with this fraction of images and refined until the threshold is stable (default: {FRACTION})",
+        type=float,
+        nargs="?",
+        const=FRACTION,
+        metavar="FRACTION",
+    )
+    parser.add_argument(
+        "--merge",
+        help="Only merge average_intensity.npy of all files and plot a histogram",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache",
+        help=f"Directory with cached average intensities of already processed files (default: {pppp_cache.CACHE_DIR})",
+        type=str,
+        default=pppp_cache.CACHE_DIR,
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="Calculate average intensity of all files again, do not use the cache",
+        action="store_true",
+        dest="no_cache",
+    )
+    parser.add_argument(
+        "--bands",
+        help="Resolution (A) edges of bands, e.g. 20 6 3 - mean intensity in every band and the ratio of the first and the last band are calculated as well",
+        type=float,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--bright",
+        help="Count also pixels with this value or higher in every image",
+        type=float,
+    )
+    parser.add_argument(
+        "--profile-bins",
+        help="Save also the radial profile of every image averaged to this number of bins",
+        type=int,
+        default=0,
+        dest="profile_bins",
+    )
+    parser.add_argument(
+        "--roi",
+        help="Use only pixels in this region of the images (rows and columns as stored in the files)",
+        type=int,
+        nargs=4,
+        metavar=("slow_start", "slow_stop", "fast_start", "fast_stop"),
+    )
+    parser.add_argument(
+        "--stride",
+        help="Use only every N-th row of pixels of the images, e.g. 10 for 10 %% of pixels - faster, enough to split pump and probe images (default: 1 - all)",
+        type=int,
+        default=1,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--mask",
+        help="Use only pixels True in a boolean array of the shape of an image saved in a .npy file",
         type=str,
     )
     parser.add_argument(
@@ -132,164 +239,130 @@ def run():
     )
     args = parser.parse_args()
 
+    scheduler = get_scheduler(args.scheduler)
+    timeline = Timeline("pppp.py")
+
     print("PPPP Pump & Probe Processing Pipeline")
     cwd = os.getcwd()
     print(f"Working directory: {cwd}")
     print("")
+    if args.detach and not scheduler.detachable:
+        sys.exit(f"Argument --detach cannot be used with --scheduler {scheduler.name}")
 
     # add -0 -1 -2 if not put in --files argument
-    files_are_full_list = True
-    for file in args.files:
-        if file[-2] != "-":
-            files_are_full_list = False
-    if files_are_full_list:
-        files = args.files
-    else:
-        files = []
-        for file in args.files:
-            files.append(file + "-0")
-            files.append(file + "-1")
-            files.append(file + "-2")
+    files = expand_files(args.files)
 
-    job_ids1 = []
-    for i, f in enumerate(files):
-        os.mkdir(f)
-        os.chdir(f)
-        with open("tags.sh", "w") as tags_sh:
-            tags_sh.write(
-                SOURCE_DIALS + "\n" + \
-                f"""dials.stills_process show_image_tags=true {args.path}/{f}/run{f}.h5 > tags.txt""")
-        subprocess.check_call(['chmod', '+x', "tags.sh"], encoding="utf-8")
-        print(f"Executing qsub tags.sh for {f}...")
-        if not args.sim:
-            p = subprocess.Popen(
-                ['qsub', '-pe', 'smp', '20', 'tags.sh'],# stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                encoding="utf-8")  # shell=settings["sh"])
-            output, err = p.communicate()
+    if args.merge:
+        with timeline.stage("merge"):
+            merge_average_intensity(files)
+        write_timing(timeline)
+        print("Done.")
+        return
 
-            if output:
-                print(f"STDOUT: {output}")
-            if err:
-                print(f"STDERR: {err}")
-            job_id = int(output.splitlines()[0].split()[2])
-            job_ids1.append(job_id)
-        else:
-            subprocess.check_call(['touch', 'tags.txt'], encoding="utf-8")
-        os.chdir("..")
-        # create files.lst for crystfel
-        with open("files.lst", "a+") as files_lst:
-            files_lst.write(args.path + "/" + f + "/run" + f + '''.h5
-''')
+    if args.path[-1] == "/":
+        args.path = args.path[:-1]
+    dataset = H5_DATASET
+    if args.geom_crystfel:
+        dataset = dataset_from_crystfel_geom(args.geom_crystfel)
 
-    print("")
-    print("List of jobs now running:")
-    print(str(job_ids1))
-    print("Waiting for the jobs to be finished...")
-    #print("Waiting for 30 seconds...")
-    #time.sleep(30)
+    try:
+        features = feature_config(args.bands, args.bright, args.profile_bins)
+        pixels = pixel_config(args.roi, args.stride, args.mask)
+    except ValueError as e:
+        sys.exit(str(e))
 
-    job_ids2 = []
-    for i, f in enumerate(files):
-        os.chdir(f)
-        wait_until_not_empty('tags.txt')
-        if not args.sim:
-            wait_until_qjob_finished(job_ids1[i])
-            with open("tags.txt", "r") as tags_txt:
-                tags_txt_lines = tags_txt.readlines()
-            #for k, line in enumerate(tags_txt_lines):
-            #    if "Showing image tags" in line:
-            #        j = k
-            #        break
-            #tags_txt_lines_strip = tags_txt_lines[j + 1:]
-            tags_txt_lines_strip = []#
-            for line in tags_txt_lines:
-                if "run" == line[:3]:
-                    tags_txt_lines_strip.append(line)
+    cache_dir = None
+    if not args.no_cache and not args.sim:
+        # absolute - the jobs run in folders of files
+        cache_dir = os.path.abspath(args.cache)
+        if os.path.isdir(cache_dir):
+            n_cached, cache_bytes = pppp_cache.cache_size(cache_dir)
+            print(f"Cache of average intensities: {cache_dir} ({n_cached} files, {cache_bytes / 2 ** 20:.1f} MB)")
         else:
-            tags_txt_lines_strip = ""
-        with open("tags.txt", "w") as tags_txt:
-            tags_txt.writelines(tags_txt_lines_strip)
-        with open("filter_average_intensity.sh", "w") as filter_sh:
-            filter_sh.write(
-                SOURCE_DIALS + "\n" + \
-                r'''dxtbx.radial_average reference_geometry=''' + args.geom + r" show_plots=false " + args.path + r"/" + f + r"/run" + f + r'''.h5 > filter_average_intensity_tmp.log
-cat filter_average_intensity_tmp.log | grep Average | awk '{print $5}' > filter_average_intensity.log
-
-i=1
-while read p; do
-  event=$(echo "$p" | cut -c13-18)
-  run=$(echo "$p" | cut -c1-12)
-  radav=$(sed "${i}q;d" filter_average_intensity.log)
-  printf "%s%s %2s\n" $run$event,$radav >> average_intensity.csv
-  i=$((i+1))
-done <tags.txt''')
-        subprocess.check_call(['chmod', '+x', "filter_average_intensity.sh"], encoding="utf-8")
-        print(f"Executing qsub filter_average_intensity.sh for {f}...")
-        if not args.sim:
-            p = subprocess.Popen(
-                ['qsub', '-pe', 'smp', '20', 'filter_average_intensity.sh'],# stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                encoding="utf-8")  # shell=settings["sh"])
-            output, err = p.communicate()
-
-            if output:
-                print(f"STDOUT: {output}")
-            if err:
-                print(f"STDERR: {err}")
-            job_id = int(output.splitlines()[0].split()[2])
-            job_ids2.append(job_id)
-        os.chdir("..")
+            print(f"Cache of average intensities: {cache_dir} (new - disable with --no-cache)")
 
+    # folders, tags.txt, files.lst and events.lst for crystfel
+    with timeline.stage("prepare files"):
+        h5_files, n_frames = prepare_files(".", args.path, files, dataset)
 
-    print("")
-    print(str(job_ids2))
-    print("Now you can have a break - time for tea or coffee!")
-
-    average_intensity_merge = []
+    if args.preview:
+        print(f"Preview from a sample of images starting with {100 * args.preview:g} %...")
+        present = [i for i, n in enumerate(n_frames) if n]
+        with timeline.stage("preview"):
+            samples, suggestion = preview([h5_files[i] for i in present], [n_frames[i] for i in present],
+                                          args.geom, dataset, args.preview, pixels=pixels)
+        print("")
+        write_preview(samples)
+        if suggestion:
+            print_suggestion(suggestion)
+        print("Run pppp.py without --preview to calculate the average intensity of all images.")
+        write_timing(timeline)
+        print("Done.")
+        return
+    with timeline.stage("cache lookup"):
+        cached = cached_average_intensity(h5_files, n_frames, args.geom, dataset, cache_dir, features, pixels)
+    todo = []  # files for which the average intensity has to be calculated
     for i, f in enumerate(files):
-        os.chdir(f)
-        if args.sim:
-            subprocess.check_call(['touch', 'average_intensity.csv'], encoding="utf-8")
-            #subprocess.check_call(['touch', 'pump.txt'])
-            #subprocess.check_call(['touch', 'probe.txt'])
-        else:
-            wait_until_qjob_finished(job_ids2[i])
-            with open("average_intensity.csv", "r") as f:
-                lines = f.readlines()
-            average_intensity_merge = average_intensity_merge + lines
-        os.chdir("..")
-
-    with open("average_intensity_all.csv", "w") as f:
-        f.write('\n'.join(average_intensity_merge))
-    print("Check data in the file average_intensity_all.csv")
-    print("You can use it to plot a histogram.")
+        if not n_frames[i]:
+            # missing or empty file - nothing to calculate, an empty table to merge
+            write_results(f"{f}/average_intensity", make_table(f, [], []))
+            print(f"File {f}: no images - skipped")
+            continue
+        if cached[i] is not None:
+            write_results(f"{f}/average_intensity", intensity_table(f, cached[i]))
+            print(f"File {f}: {n_frames[i]} images - average intensity taken from the cache")
+            continue
+        print(f"File {f}: {n_frames[i]} images")
+        todo.append(i)
+        if not args.local:
+            write_intensity_job(f, h5_files[i], args.geom, PPPP_INTENSITY, dataset, cache_dir, SOURCE_DIALS, features,
+                                pixels)
+    print("Created events.lst for CrystFEL")
 
-    # try:
-    # import numpy as np
-    # import matplotlib.pyplot as plt
-    # from pandas import read_csv
-    # print("Plotting the result...")
-    outputplot = plot_histogram(inputfile='average_intensity_all.csv', outputplot='average_intensity_all.png')
-    # print(f"Histogram plotted to {outputplot}")
-    # except:
-    # print(f"Histogram not plotted. :-(")
+    todo_files = [files[i] for i in todo]
+    ready = None  # files in the order their results become available, None - all available
+    if not todo:
+        print("Average intensity of all files taken from the cache.")
+    elif args.local:
+        if not args.sim:
+            print(f"Calculating average intensity using {args.local} processes...")
+            with timeline.stage("average intensity"):
+                values = average_intensity_files([h5_files[i] for i in todo], [n_frames[i] for i in todo],
+                                                 args.geom, args.local, dataset, cache_dir, features, pixels)
+            for i, v in zip(todo, values):
+                write_results(f"{files[i]}/average_intensity", intensity_table(files[i], v))
+    else:
+        write_array_script("filter_average_intensity_array.sh", todo_files, "filter_average_intensity.sh")
+        graph = JobGraph()
+        graph.add("intensity", "filter_average_intensity_array.sh", n_tasks=len(todo_files))
+        if args.detach:
+            with open("merge.sh", "w") as merge_sh:
+                merge_sh.write(
+                    SOURCE_DIALS + "\n" + \
+                    f"""cd {cwd} && {sys.executable} {os.path.abspath(__file__)} --dir {args.path} --files {' '.join(files)} --geom {args.geom} --merge""")
+            graph.add("merge", "merge.sh", options=[], after=["intensity"])
+        print(f"Executing {scheduler.name} filter_average_intensity_array.sh for {len(todo_files)} files...")
+        if not args.sim:
+            submitted = time.time()
+            job_ids = graph.submit(scheduler)
+            timeline.submitted(job_ids, {"intensity": len(todo_files)}, at=submitted)
+            print("")
+            print(str(job_ids))
+        if args.detach:
+            print("Results will be merged to average_intensity_all.npy by the merge job when all average intensities are calculated.")
+            write_timing(timeline)
+            print("Done.")
+            return
+        print("Now you can have a break - time for tea or coffee!")
 
-    if args.geom_crystfel:
-        print("Creating events.lst for CrystFEL")
-        try:
-            p = subprocess.Popen(
-                SOURCE_CRYSTFEL + ' && list_events -i files.lst -o events.lst -g '+ args.geom_crystfel,# stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                encoding="utf-8", shell=True)
-            output, err = p.communicate()
-            if output:
-                print(f"STDOUT: {output}")
-            if err:
-                print(f"STDERR: {err}")
-        except:
-            print("Error occured while creating events.lst for CrystFEL")
+        if not args.sim:
+            tracker = JobTracker(scheduler, timeline=timeline).add(job_ids["intensity"], array_sentinels("filter_average_intensity_array.sh", len(todo_files)))
+            ready = completed_files(tracker, files, todo_files)
+    # with jobs, files are merged as they finish
+    with timeline.stage("merge" if ready is None else "jobs and merge"):
+        merge_average_intensity(files, args.sim, ready=ready)
 
+    write_timing(timeline)
     print("Done.")
 
 
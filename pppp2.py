@@ -5,7 +5,14 @@ from pathlib import Path
 import subprocess
 import time
 import numpy as np
-import h5py
+from pppp_api import (create_dose_point_h5, dials_phil, dose_point_split, expand_files, job_size, pack_frames,
+                      write_dials_jobs, write_group_vds, write_reduce_job, write_xia2_job)
+from pppp_events import H5_DATASET, h5_path, merge_events_lst, read_events_index, tag_event
+from pppp_sweep import find_results
+from pppp_table import load_results
+from pppp_threshold import print_suggestion, suggest_threshold
+from pppp_jobs import MAX_CONCURRENT, QSUB_OPTIONS, SCHEDULERS, JobGraph, JobTracker, array_sentinels, get_scheduler, write_array_script
+from pppp_timing import Timeline, write_timing
 
 # ----------------------------------------------------------------------
 # pppp - X-ray Pump and Probe Processing Pipeline
@@ -16,6 +23,8 @@ import h5py
 # ----------------------------------------------------------------------
 # EXAMPLE USAGE
 # dials.python pppp2.py --threshold 30 --files 133357 133358 --dir /path/to/cheetah/ --events /path/to/events.lst
+# dials.python pppp2.py --threshold auto --files 133357 133358 --dir /path/to/cheetah/
+# dials.python pppp2.py --bins 20 25 30 35 --files 133357 133358 --dir /path/to/cheetah/ --events /path/to/events.lst
 #
 # dials.python pppp2.py --threshold 32 35 \
 #     --files 133357-0 133357-1 133357-2 133358-0 133358-1 133358-2 133359-0 133359-1 133359-2 \
@@ -26,6 +35,7 @@ import h5py
 #     --spacegroup P21 --cell 50.0 60.0 70.0 90.0 90.0 90.0 --d_min 1.6 \
 #     --xia2 --dials
 # ----------------------------------------------------------------------
+# Timings of stages and jobs are saved in pppp2_timing.json and pppp2_trace.json
 #
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 #            IMPORTANT SETTING - PATH TO DIALS
@@ -35,123 +45,31 @@ SOURCE_DIALS = "module load dials/nightly"
 # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
 
-# https://stackoverflow.com/questions/2785821/is-there-an-easy-way-in-python-to-wait-until-certain-condition-is-true
-def wait_until_qjob_finished(job_id, period=5):
-    first_cycle = True
-    while True:
-        p = subprocess.Popen(
-            ['qstat', '-j', str(job_id)],# stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            encoding="utf-8")  # shell=settings["sh"])
-        output, err = p.communicate()
-        if "Following jobs do not exist or permissions are not sufficient:" in str(output) or "Following jobs do not exist or permissions are not sufficient:" in str(err):
-            print("")
-            print("Job finished: " + str(job_id))
-            return True
-        if first_cycle:
-            print("")
-            print("Still waiting for job  " + str(job_id), end="")
-            first_cycle = False
-        else:
-            print(".", end="")
-        time.sleep(period)
-    return False
-
-
-def isfile_or_touch(path):
-    if os.path.isfile(path):
-        print(f"File created: {os.path.basename(os.getcwd())}/{path}")
-    else:
-        Path(path).touch()
-        print(f"File empty:  {os.path.basename(os.getcwd())}/{path}")
-    return
-
-
-def create_dose_point_h5(dir, threshold_low, threshold_high=None, events=None):
-    """Creates files for:
-       * xia2.ssx: filename_dose_point.h5, run_xia2.sh, run_xia2.phil, run_xia2.yml
-       * dials.stills_process: run_dials.sh, run_dials.phil, run_xia2_process.sh
-       * CrystFEL: events_pump.lst events_probe.lst events_not_assigned.lst"""
-    if not threshold_high:
-        threshold_high = threshold_low
-    with open("average_intensity.csv", "r") as f:
-        lines = f.readlines()
-    if len(lines) == 1:
-        lines = lines[0].split()
-    if os.path.isfile("pump.txt"): os.remove("pump.txt")
-    if os.path.isfile("probe.txt"): os.remove("probe.txt")
-    if os.path.isfile("not_assigned.txt"): os.remove("not_assigned.txt")
-    if events:
-        if os.path.isfile("events_pump.lst"): os.remove("events_pump.lst")
-        if os.path.isfile("events_probe.lst"): os.remove("events_probe.lst")
-        if os.path.isfile("events_not_assigned.lst"): os.remove("events_not_assigned.lst")
-        with open(events, "r") as f_events:
-            lines_events_all = f_events.readlines()
-    a = np.array([], dtype='i')
-    for i, l in enumerate(lines):
-        if lines[i].strip() == "":
-            continue
-        line = lines[i].strip().split(",")
-        run = line[0]
-        rad_average = float(line[1])
-        file_h5 = run.split("_")[0].replace("run", "")
-        # event = str(int(run.split("_")[1]))
-        # line_crystfel = f"{dir}/{file_h5}/run{file_h5}.h5 //{event} \n"
-        if i == 0:
-            print(f"File {file_h5}")
-        if events:
-            if i == 0:
-                lines_events = list(filter(lambda x:file_h5 in x, lines_events_all))
-                print(f"No. of events: {str(len(lines_events))}")
-            line_event = lines_events[i]
-        if rad_average < threshold_low:
-            a = np.append(a, 0)
-            with open("pump.txt", "a+") as f:
-                f.write(run + "\n")
-            if events:
-                with open("events_pump.lst", "a+") as f:
-                    f.write(line_event)
-        elif rad_average >= threshold_high:
-            a = np.append(a, 1)
-            with open("probe.txt", "a+") as f:
-                f.write(run + "\n")
-            if events:
-                with open("events_probe.lst", "a+") as f:
-                    f.write(line_event)
-        else:
-            a = np.append(a, 2)
-            with open("not_assigned.txt", "a+") as f:
-                f.write(run + "\n")
-            if events:
-                with open("events_not_assigned.lst", "a+") as f:
-                    f.write(line_event)
-    isfile_or_touch("pump.txt")
-    isfile_or_touch("probe.txt")
-    if os.path.isfile("not_assigned.txt"): print(f"File created: {os.path.basename(os.getcwd())}/not_assigned.txt")
-    if events:
-        isfile_or_touch("events_pump.lst")
-        isfile_or_touch("events_probe.lst")
-        if os.path.isfile("events_not_assigned.lst"): print(f"File created: {os.path.basename(os.getcwd())}/events_not_assigned.lst")
-    f = h5py.File(os.path.basename(os.getcwd()) + '_dose_point.h5', 'w')
-    f.create_dataset("dose_point", data=a)
-    f.close()
-    print(f"File created: {os.path.basename(os.getcwd())}/{os.path.basename(os.getcwd())}_dose_point.h5")
-    print("")
-    return
-
-
 def run():
     parser = argparse.ArgumentParser(
         description="pppp - Pump and Probe Processing Pipeline - 2nd script - split diffraction images according to the threshold - average total scattered intensity"
     )
-    parser.add_argument(
+    split_group = parser.add_mutually_exclusive_group(required=True)
+    split_group.add_argument(
         "--threshold",
-        type=float,
-        help="Threshold that divides pump and probe data",
-        required=True,
+        type=str,
+        help="Threshold that divides pump and probe data, or 'auto' to estimate threshold_low and threshold_high from the distribution of average intensities",
         nargs='+',
         metavar=('threshold_low', 'threshold_high'),
     )
+    split_group.add_argument(
+        "--bins",
+        type=float,
+        help="Edges of intensity bins - split images to groups bin0 (below the first edge), bin1, ... binN (the last edge or above) instead of pump and probe",
+        nargs='+',
+        metavar='edge',
+    )
+    parser.add_argument(
+        "--feature",
+        help="Column of average_intensity.npy used for the splitting instead of the average intensity, e.g. band_ratio or n_bright (calculated by pppp.py --bands --bright)",
+        type=str,
+        default="intensity",
+    )
     parser.add_argument(
         "--dir", "--path",
         help="Absolute path to the directory with data",
@@ -229,6 +147,42 @@ def run():
         metavar=("cell_a", "cell_b", "cell_c", "cell_alpha", "cell_beta", "cell_gamma"),
         # required=True
     )
+    parser.add_argument(
+        "--dataset",
+        help=f"Dataset with the frames (default: {H5_DATASET})",
+        type=str,
+        default=H5_DATASET,
+    )
+    parser.add_argument(
+        "--frames-per-job",
+        help="Maximal number of images processed by a single dials.stills_process job (default: all images divided evenly to as many jobs as there are files and groups)",
+        type=int,
+        dest="frames_per_job",
+    )
+    parser.add_argument(
+        "--image-tags",
+        help="Select images of groups by image tags in run_dials.phil and the dose point of all images for xia2.ssx, instead of virtual datasets <file>_<group>.h5",
+        action="store_true",
+        dest="image_tags",
+    )
+    parser.add_argument(
+        "--scheduler",
+        help="Batch system used to execute jobs (default: qsub)",
+        choices=sorted(SCHEDULERS),
+        default="qsub",
+    )
+    parser.add_argument(
+        "--wait",
+        help="Wait until all submitted jobs have finished",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-concurrent",
+        help=f"Number of jobs submitted at the same time (default: {MAX_CONCURRENT})",
+        type=int,
+        default=MAX_CONCURRENT,
+        dest="max_concurrent",
+    )
     parser.add_argument(
         "--sim", "--simulate",
         help="Simulate: create files but not execute qsub jobs",
@@ -236,6 +190,8 @@ def run():
         dest="sim",
     )
     args = parser.parse_args()
+    scheduler = get_scheduler(args.scheduler)
+    timeline = Timeline("pppp2.py")
 
     print("PPPP Pump & Probe Processing Pipeline - step 2")
     print("2nd script - split diffraction images according to the threshold - average total scattered intensity")
@@ -243,226 +199,171 @@ def run():
     print(f"Working directory: {cwd}")
     print("")
 
-    if len(args.threshold) == 1:
-        threshold_low = args.threshold[0]
-        threshold_high = args.threshold[0]
-    elif len(args.threshold) == 2:
-        threshold_low = args.threshold[0]
-        threshold_high = args.threshold[1]
-    elif len(args.threshold) > 2:
-        sys.exit('Argument --threshold takes one or two values')
+    auto_threshold = args.threshold == ["auto"]
+    if args.threshold and not auto_threshold:
+        try:
+            args.threshold = [float(t) for t in args.threshold]
+        except ValueError:
+            sys.exit("Argument --threshold takes one or two values or 'auto'")
+        if len(args.threshold) == 1:
+            threshold_low = args.threshold[0]
+            threshold_high = args.threshold[0]
+        elif len(args.threshold) == 2:
+            threshold_low = args.threshold[0]
+            threshold_high = args.threshold[1]
+        elif len(args.threshold) > 2:
+            sys.exit('Argument --threshold takes one or two values')
     # TO DO     if not args.just_split and not ...
 
     if args.files:
         # add -0 -1 -2 if not put in --files argument
-        files_are_full_list = True
-        for file in args.files:
-            if file[-2] != "-":
-                files_are_full_list = False
-        if files_are_full_list:
-            files = args.files
-        else:
-            files = []
-            for file in args.files:
-                files.append(file + "-0")
-                files.append(file + "-1")
-                files.append(file + "-2")
+        files = expand_files(args.files)
     else:
-        files = [ f.path for f in os.scandir(".") if f.is_dir() ]
-        for i, f in enumerate(files):
-            files[i] = files[i].replace(".", "")
-            files[i] = files[i].replace("/", "")
+        files = find_results()
 
     if args.path[-1] == "/":
         args.path = args.path[:-1]
 
-    events_pump_merge = []
-    events_probe_merge = []
+    if args.feature != "intensity" or not args.skip_splitting:
+        n_images = 0
+        n_undefined = 0  # NaN, e.g. a resolution band without pixels
+        for f in files:
+            table = load_results(f"{f}/average_intensity")
+            dtype = table.dtype
+            if args.feature not in dtype.names or dtype[args.feature].shape:
+                sys.exit(f"Feature {args.feature} not found in {f}/average_intensity.npy - "
+                         f"available: {' '.join(n for n in dtype.names if not dtype[n].shape and n not in ('run', 'event', 'group'))}")
+            n_images += table.size
+            n_undefined += int(np.count_nonzero(~np.isfinite(table[args.feature])))
+        if n_undefined > n_images / 2:
+            print(f"WARNING: {args.feature} is not defined (NaN) for {n_undefined} of {n_images} images - "
+                  f"they are not assigned to any group")
+
+    if auto_threshold:
+        print("Estimating the threshold from the distribution of average intensities...")
+        with timeline.stage("threshold"):
+            values = np.concatenate([load_results(f"{f}/average_intensity")[args.feature] for f in files])
+            try:
+                suggestion = suggest_threshold(values)
+            except ValueError as e:
+                sys.exit(f"Threshold cannot be estimated: {e}")
+        print_suggestion(suggestion)
+        threshold_low = suggestion["threshold_low"]
+        threshold_high = suggestion["threshold_high"]
+        print("")
+
+    if args.bins:
+        split = dose_point_split(bins=args.bins)
+    else:
+        split = dose_point_split(threshold_low, threshold_high)
+    groups = split["processed"]
+
+    group_tags = {}  # file: {group: image tags}
     if not args.skip_splitting:
-        print(f"Separating images to groups using a threshold: {str(threshold_low)} {str(threshold_high)}...")
+        if args.bins:
+            print(f"Separating images to groups {' '.join(groups)} using bin edges: {' '.join(str(e) for e in split['edges'])}...")
+        else:
+            print(f"Separating images to groups using a threshold: {str(threshold_low)} {str(threshold_high)}...")
+        if args.feature != "intensity":
+            print(f"Images are split on the feature {args.feature} instead of the average intensity")
+        events = None
+        if args.events:
+            events = read_events_index(args.events)
         for i, f in enumerate(files):
-            os.chdir(f)
-            events = None
-            if args.events:
-                events = args.events
-            create_dose_point_h5(args.path, threshold_low, threshold_high, events)
-            if args.events:
-                with open("events_pump.lst", "r") as events_pump_lst:
-                    events_pump_lines = events_pump_lst.readlines()
-                with open("events_probe.lst", "r") as events_probe_lst:
-                    events_probe_lines = events_probe_lst.readlines()
-                events_pump_merge = events_pump_merge + events_pump_lines
-                events_probe_merge = events_probe_merge + events_probe_lines
-            os.chdir("..")
+            with timeline.stage(f"split {f}"):
+                group_tags[f], _ = create_dose_point_h5(f, split, events, args.feature)
     if args.events:
-        with open("events_pump.lst", "w") as f:
-            f.write(''.join(events_pump_merge))
-        with open("events_probe.lst", "w") as f:
-            f.write(''.join(events_probe_merge))
+        # events_<group>.lst of all files merged in the order of files and events
+        with timeline.stage("merge events lists"):
+            for group in groups:
+                n = merge_events_lst(f"events_{group}.lst", [f"{f}/events_{group}.lst" for f in files])
+                print(f"File created: events_{group}.lst ({n} events)")
 
-    #
-    # Create run_xia2.yml
-    #
-    with open("run_xia2.yml", "w") as r:
-        r.write(f"metadata:\n  dose_point:\n")
+    # virtual dataset <file>_<group>.h5 with images of every file and group for xia2.ssx and dials.stills_process,
+    # written only if they are run
+    images = {}  # virtual datasets: their dose point
+    group_frames = {group: {} for group in groups}  # frames of every group and file
+    group_vds = {group: {} for group in groups}  # virtual dataset and frames of every group and file
+    with timeline.stage("virtual datasets"):
         for i, f in enumerate(files):
-            r.write(f'    "{args.path}/{f}/run{f}.h5" : "{os.getcwd()}/{f}/{f}_dose_point.h5:/dose_point"\n')
-        r.write("""grouping:
-  merge_by:
-    values: 
-      - dose_point""")
-
-    f_list = []
-    for i, f in enumerate(files):
-        f_list.append(f"{f}/run{f}")
-    f_str = ",".join(f_list)
-
-    #
-    # Create run_xia2.sh
-    #
-    with open("run_xia2.sh", "w") as r:
-        r.write(f"""{SOURCE_DIALS}
-xia2.ssx run_xia2.phil image={args.path}/""" + "{" + f_str + "}.h5")
-
-    #
-    # Create run_xia2.phil
-    #
-    with open("run_xia2.phil", "w") as r:
-        r.write(f"""spotfinding.min_spot_size=2
-spotfinding.max_spot_size=10
-grouping=run_xia2.yml""")
-        if args.geom: r.write(f"\nreference_geometry={args.geom}")
-        if args.mask: r.write(f"\nmask={args.mask}")
-        if args.spacegroup: r.write(f"\nspace_group={args.spacegroup}")
-        if args.geom: r.write(f"\nreference={args.pdb}")
-        if args.d_min: r.write(f"\nd_min={args.d_min}")
-        if args.cell:
-            cell_str = str(args.cell[0]) + " " + str(args.cell[1]) + " " + str(args.cell[2]) + " " + str(args.cell[3]) + " " + str(args.cell[4]) + " " + str(args.cell[5])
-            cell_str_comma = str(args.cell[0]) + ", " + str(args.cell[1]) + ", " + str(args.cell[2]) + ", " + str(args.cell[3]) + ", " + str(args.cell[4]) + ", " + str(args.cell[5])
-            r.write(f"\nindexing.unit_cell={cell_str}")
+            h5_file = h5_path(args.path, f)
+            for group in groups:
+                if f in group_tags:
+                    tags = group_tags[f][group]
+                else:
+                    with open(f"{f}/{group}.txt", "r") as p:
+                        tags = p.readlines()
+                group_frames[group][f] = np.array([tag_event(tag.strip())[1] for tag in tags], dtype=np.int64)
+                if args.image_tags or not (args.xia2 or args.dials) or not os.path.isfile(h5_file):
+                    continue
+                os.makedirs(f"{f}/{group}", exist_ok=True)
+                vds = os.path.abspath(f"{f}/{group}/{f}_{group}.h5")
+                write_group_vds(vds, h5_file, group_frames[group][f], args.dataset,
+                                dose_point=split["groups"].index(group))
+                images[vds] = f"{vds}:/dose_point"
+                group_vds[group][f] = (vds, group_frames[group][f])
 
-    #
-    # Create run_dials.phil
-    #
-    run_dials_phil_base = f"""spotfinder.filter.min_spot_size=2
-spotfinder.filter.max_spot_size=10
-#significance_filter.enable=True
-#significance_filter.isigi_cutoff=1.0
-mp.nproc = 20
-mp.method=multiprocessing
-#refinement.parameterisation.detector.fix=none"""
-    if args.geom: run_dials_phil_base += f"\ninput.reference_geometry={args.geom}"
-    if args.mask:
-        run_dials_phil_base += f"\nspotfinder.lookup.mask={args.mask}"
-        run_dials_phil_base += f"\nintegration.lookup.mask={args.mask}"
-    run_dials_phil_base += """
-indexing {
-  stills.indexer=stills
-  stills.method_list=fft1d real_space_grid_search
-  multiple_lattice_search.max_lattices=3"""
-    if args.spacegroup and args.cell:
-        run_dials_phil_base += """
-  known_symmetry {
-    space_group = """ + args.spacegroup + """
-     unit_cell = """ + cell_str_comma + """
-  }"""
-    run_dials_phil_base += "\n}"
-    if args.d_min:
-        run_dials_phil_base += f"\nspotfinder.filter.d_min={args.d_min}\n"
+    # run_xia2.yml, run_xia2.sh and run_xia2.phil for xia2.ssx
+    with timeline.stage("xia2 job files"):
+        write_xia2_job(".", args.path, files, args.geom, args.mask, args.spacegroup, args.pdb, args.d_min, args.cell,
+                       SOURCE_DIALS, images or None)
 
-    #
-    # Create run_dials.sh
-    #
-    with open("run_dials.sh", "w") as r:
-        run_dials_sh_base = f"{SOURCE_DIALS}\n" \
-            "dials.stills_process run_dials.phil "
-    groups = ["pump", "probe"]
-    for i, f in enumerate(files):
-        os.chdir(f)
+    # dials.stills_process jobs of about the same number of images - <group>/job_001 ...
+    dials_dirs = {}
+    if args.dials:
+        frames_per_job = args.frames_per_job or job_size(group_frames, len(files) * len(groups))
+        phil = dials_phil(args.geom, args.mask, args.spacegroup, args.cell, args.d_min)
         for group in groups:
-            with open(f"{group}.txt", "r") as p:
-                images = p.read()
-            os.mkdir(group)
-            os.chdir(group)
-            with open("run_dials.phil", "w") as r:
-                r.write(run_dials_phil_base)
-                for line in images.splitlines():
-                    r.write(f"input.image_tag={line}\n")
-            with open("run_dials.sh", "w") as r:
-                r.write(run_dials_sh_base)
-                r.write(f"{args.path}/{f}/run{f}.h5")
-            os.chdir("..")
-        os.chdir("..")
+            jobs = pack_frames(group_frames[group], frames_per_job)
+            with timeline.stage(f"dials job files {group}"):
+                dials_dirs[group] = write_dials_jobs(group, args.path, jobs, phil, args.dataset, args.image_tags,
+                                                     SOURCE_DIALS, group_vds[group])
+            sizes = [sum(len(frames) for f, frames in job) for job in jobs]
+            print(f"Group {group}: {sum(sizes)} images in {len(jobs)} dials.stills_process jobs"
+                  + (f" of {min(sizes)} - {max(sizes)} images" if sizes else ""))
 
     # if args.just_split:
     #     print("Done.")
     #     return
 
+    #
+    # Submit jobs - all at once, the batch system starts each of them when its inputs are ready
+    #
+    graph = JobGraph()
     if args.xia2:
-        print(f"Executing xia2.ssx...")
-        p = subprocess.Popen(
-            ['qsub', '-pe', 'smp', '20', '-q', 'medium.q', 'run_xia2.sh'],# stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            encoding="utf-8")  # shell=settings["sh"])
-        output, err = p.communicate()
-        if output:
-            print(f"STDOUT: {output}")
-        if err:
-            print(f"STDERR: {err}")
-        job_id = int(output.splitlines()[0].split()[2])
+        graph.add("xia2", "run_xia2.sh", options=QSUB_OPTIONS + ['-q', 'medium.q'])
 
     if args.dials:
-        print(f"Executing dials.stills_process jobs...")
-        job_ids1 = []
-        for i, f in enumerate(files):
-            os.chdir(f)
-            for group in groups:
-                os.chdir(group)
-                print(f"Executing dials.stills_process... {f} {group}")
-                p = subprocess.Popen(
-                    ['qsub', '-pe', 'smp', '20', 'run_dials.sh'],# stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                    encoding="utf-8")  # shell=settings["sh"])
-                output, err = p.communicate()
-                if output:
-                    print(f"STDOUT: {output}")
-                if err:
-                    print(f"STDERR: {err}")
-                job_id = int(output.splitlines()[0].split()[2])
-                job_ids1.append(job_id)
-                os.chdir("..")
-            os.chdir("..")
-        print("")
-        print(str(job_ids1))
-        print("Now you can have a break - time for tea or coffee!")
-
-        for j in range(len(job_ids1)):
-            wait_until_qjob_finished(job_ids1[j])
-
-        job_ids2 = []
         for group in groups:
-            os.mkdir(group)
-            os.chdir(group)
-            # run_ssx_reduce.sh
-            with open("run_xia2_reduce.sh", "w") as r:
-                r.write(SOURCE_DIALS + "\n")
-                r.write("xia2.ssx_reduce ")
-                for i, f in enumerate(files):
-                    r.write("../" + f + "/" + group + "/idx-*_integrated*.{expt,refl} ")
-            print(f"Executing xia2.ssx_reduce... {group}")
-            p = subprocess.Popen(
-                ['qsub', '-pe', 'smp', '20', '-q', 'medium.q', 'run_xia2_reduce.sh'],# stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                encoding="utf-8")  # shell=settings["sh"])
-            output, err = p.communicate()
-            if output:
-                print(f"STDOUT: {output}")
-            if err:
-                print(f"STDERR: {err}")
-            job_id = int(output.splitlines()[0].split()[2])
-            job_ids2.append(job_id)
-            os.chdir("..")
-        print(str(job_ids2))
+            if not dials_dirs[group]:
+                print(f"WARNING: No images in group {group}, dials.stills_process not executed")
+                continue
+            # dials.stills_process for all jobs of a group as an array job
+            write_array_script(f"run_dials_{group}_array.sh", dials_dirs[group], "run_dials.sh")
+            graph.add(f"dials_{group}", f"run_dials_{group}_array.sh", n_tasks=len(dials_dirs[group]))
+            # run_ssx_reduce.sh - starts when dials.stills_process has finished for all jobs of the group
+            write_reduce_job(group, dials_dirs[group], SOURCE_DIALS)
+            graph.add(f"reduce_{group}", "run_xia2_reduce.sh", options=QSUB_OPTIONS + ['-q', 'medium.q'],
+                      cwd=group, after=[f"dials_{group}"])
+
+    if graph.jobs:
+        print(f"Executing jobs: {' '.join(graph.jobs)}")
+        submitted = time.time()
+        with timeline.stage("submission"):
+            job_ids = graph.submit(scheduler, args.max_concurrent)
+        timeline.submitted(job_ids, {name: job["n_tasks"] for name, job in graph.jobs.items()}, at=submitted)
+        print("")
+        print(str(job_ids))
+        if scheduler.detachable and not args.wait:
+            print("All jobs submitted, they will continue on their own.")
+        else:
+            print("Now you can have a break - time for tea or coffee!")
+            tracker = JobTracker(scheduler, timeline=timeline)
+            for name, job_id in job_ids.items():
+                n_tasks = graph.jobs[name]["n_tasks"]
+                tracker.add(job_id, array_sentinels(graph.jobs[name]["script"], n_tasks) if n_tasks else None)
+            tracker.wait_all()
+    write_timing(timeline)
     return
 
 if __name__ == "__main__":
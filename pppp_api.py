@@ -0,0 +1,471 @@
+import os
+import sys
+from pathlib import Path
+import numpy as np
+import h5py
+import pppp_cache
+from pppp_events import H5_DATASET, count_frames, frame_tag, frame_tags, h5_path, write_events_lst, write_tags
+from pppp_intensity import (N_BINS, average_intensity_h5, feature_dtype, feature_options, load_reference_geometry,
+                            pixel_index, pixel_options)
+from pppp_jobs import make_executable
+from pppp_local import average_intensity_local
+from pppp_table import load_results, make_table, table_dtype, table_tags, write_table
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# library layer used by pppp.py and pppp2.py
+#
+# Functions take and return NumPy arrays and paths - every file is
+# written to a directory given explicitly and the working directory is
+# never changed, so several analyses can run in one process (e.g. from
+# a notebook or another workflow manager).
+#
+#   frames:         expand_files, prepare_files
+#   intensity:      average_intensity_files, intensity_table, write_intensity_job
+#   classification: dose_point_split, digitize, classify, split_images
+#   job files:      write_split, create_dose_point_h5, dials_phil, write_dials_job,
+#                   write_group_vds, write_reduce_job, write_xia2_job
+#   dials jobs:     job_size, pack_frames, write_dials_jobs
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# from pppp_api import *
+# h5_files, n_frames = prepare_files("analysis", "/path/to/cheetah", expand_files(["133451"]))
+# values = average_intensity_files(h5_files, n_frames, "/path/to/refined.expt", n_proc=16)
+# dose_point = digitize(np.concatenate(values), dose_point_split(30))
+# ----------------------------------------------------------------------
+
+
+def expand_files(files):
+    """Names of files - runs are expanded to files -0 -1 -2 unless all
+    names are files already, e.g. 133451 -> 133451-0 133451-1 133451-2"""
+    if all(file[-2] == "-" for file in files):
+        return list(files)
+    return [f"{file}-{i}" for file in files for i in range(3)]
+
+
+def isfile_or_touch(path):
+    path = Path(path)
+    if path.is_file():
+        print(f"File created: {path.parent.name}/{path.name}")
+    else:
+        path.touch()
+        print(f"File empty:  {path.parent.name}/{path.name}")
+    return path
+
+
+def prepare_files(directory, path, files, dataset=H5_DATASET):
+    """Folder and tags.txt for every file, files.lst and events.lst for
+    CrystFEL in directory. Returns paths of the HDF5 files and numbers
+    of their frames (0 if a file is missing)."""
+    directory = Path(directory)
+    h5_files = []
+    n_frames = []
+    for f in files:
+        (directory / f).mkdir(parents=True, exist_ok=True)
+        h5_file = h5_path(path, f)
+        if os.path.isfile(h5_file):
+            n = count_frames(h5_file, dataset)
+        else:
+            print(f"WARNING: File not found: {h5_file}")
+            n = 0
+        write_tags(directory / f / "tags.txt", frame_tags(h5_file, n))
+        h5_files.append(h5_file)
+        n_frames.append(n)
+    with open(directory / "files.lst", "w") as files_lst:
+        files_lst.write("".join(h5_file + "\n" for h5_file in h5_files))
+    write_events_lst(directory / "events.lst", h5_files, n_frames)
+    return h5_files, n_frames
+
+
+def cached_average_intensity(h5_files, n_frames, geom, dataset=H5_DATASET, cache_dir=None, features=None, pixels=None):
+    """Average intensities (or features) from the cache - a list with an
+    array or None (not cached) for every file."""
+    values = []
+    for h5_file, n in zip(h5_files, n_frames):
+        v = None
+        if cache_dir and n:
+            v = pppp_cache.load(pppp_cache.cache_key(h5_file, geom, dataset, N_BINS, features=features, pixels=pixels),
+                                cache_dir)
+        values.append(v if v is not None and v.size == n else None)
+    return values
+
+
+def average_intensity_files(h5_files, n_frames, geom, n_proc=1, dataset=H5_DATASET, cache_dir=None, features=None,
+                            pixels=None):
+    """Average intensity of all frames of all files as a list of arrays,
+    calculated in this process (n_proc > 1: a pool of processes). With
+    features (pppp_intensity.feature_config), the arrays are structured
+    with the features calculated in the same pass. Only pixels from
+    pppp_intensity.pixel_config are used if given. Results are taken
+    from and added to the cache if cache_dir is given."""
+    values = cached_average_intensity(h5_files, n_frames, geom, dataset, cache_dir, features, pixels)
+    todo = [i for i, v in enumerate(values) if v is None]
+    if not todo:
+        return values
+    index = pixel_index(load_reference_geometry(geom), pixels)
+    if n_proc > 1:
+        calculated = average_intensity_local([h5_files[i] for i in todo], [n_frames[i] for i in todo],
+                                             index, n_proc, dataset, features=features)
+    else:
+        calculated = [average_intensity_h5(h5_files[i], index, dataset, features=features) if n_frames[i]
+                      else np.zeros(0, dtype=feature_dtype(features) if features else np.float64) for i in todo]
+    for i, v in zip(todo, calculated):
+        values[i] = v
+        if cache_dir and n_frames[i]:
+            pppp_cache.store(pppp_cache.cache_key(h5_files[i], geom, dataset, N_BINS, features=features, pixels=pixels),
+                             v, cache_dir)
+    return values
+
+
+def intensity_table(f, values):
+    """Table of results of file f, frames in order"""
+    return make_table(f, np.arange(len(values)), values)
+
+
+def write_intensity_job(directory, h5_file, geom, engine, dataset=H5_DATASET, cache_dir=None, source_dials="", features=None,
+                        pixels=None):
+    """filter_average_intensity.sh - runs the engine (pppp_intensity.py) for
+    a single file in its folder."""
+    filename = Path(directory) / "filter_average_intensity.sh"
+    cache_option = f" --cache {cache_dir}" if cache_dir else ""
+    with open(filename, "w") as filter_sh:
+        filter_sh.write(
+            source_dials + "\n" + \
+            f"""{sys.executable} {engine} --geom {geom} --dataset {dataset} --tags tags.txt --output average_intensity.npy --csv average_intensity.csv{cache_option}{feature_options(features)}{pixel_options(pixels)} {h5_file}""")
+    return make_executable(filename)
+
+
+def dose_point_split(threshold_low=None, threshold_high=None, bins=None):
+    """How images are split to groups by their average intensity:
+       * edges - ascending edges of intensity bins
+       * dose_points - dose point of the images in every bin
+       * groups - name of every dose point
+       * processed - groups processed by dials.stills_process
+       * undefined - dose point of images without a value (NaN)
+    Threshold(s): pump (below threshold_low), probe (threshold_high or
+    above) and not_assigned between them and for NaN. Bins: groups bin0
+    (below the first edge), bin1, ... binN (the last edge or above), NaN
+    is in no group (dose point -1)."""
+    if bins is not None:
+        edges = np.sort(np.asarray(bins, dtype=np.float64))
+        groups = [f"bin{i}" for i in range(edges.size + 1)]
+        return {"edges": edges, "dose_points": np.arange(edges.size + 1), "groups": groups, "processed": groups,
+                "undefined": -1}
+    if threshold_high is None or threshold_high <= threshold_low:
+        edges, dose_points = [threshold_low], [0, 1]
+    else:
+        edges, dose_points = [threshold_low, threshold_high], [0, 2, 1]
+    return {"edges": np.array(edges, dtype=np.float64), "dose_points": np.array(dose_points),
+            "groups": ["pump", "probe", "not_assigned"], "processed": ["pump", "probe"], "undefined": 2}
+
+
+def digitize(values, split):
+    """Dose point of every image - a single pass over the values.
+    np.digitize puts NaN above the last edge, so non-finite values get
+    the dose point split["undefined"]."""
+    values = np.asarray(values, dtype=np.float64)
+    dose_point = split["dose_points"][np.digitize(values, split["edges"])].astype(np.int64)
+    dose_point[~np.isfinite(values)] = split["undefined"]
+    return dose_point
+
+
+def classify(values, threshold_low, threshold_high=None):
+    """Dose point of every image: 0 - pump (below threshold_low),
+    1 - probe (threshold_high or above), 2 - not assigned (also NaN)."""
+    return digitize(values, dose_point_split(threshold_low, threshold_high))
+
+
+def split_images(table, split, events=None, feature="intensity"):
+    """Dose point of every image of a table, image tags of every group and,
+    if events (an index from read_events_index) are given, lines of
+    events.lst of every group. Images are matched with events by their
+    event number. Images are split on the column feature of the table."""
+    tags = np.array(table_tags(table), dtype=str)
+    dose_point = digitize(table[feature], split)
+    lines_events = None
+    if events is not None:
+        run_events = events.get(f"run{table['run'][0].decode()}", {}) if tags.size else {}
+        print(f"No. of events: {str(len(run_events))}")
+        lines_events = []
+        for tag, event in zip(tags, table["event"]):
+            line = run_events.get(int(event))
+            if line is None:
+                print(f"WARNING: Event not found in the events file: {tag}")
+                line = ""
+            lines_events.append(line)
+        lines_events = np.array(lines_events, dtype=object)
+    group_tags = {}
+    group_events = {}
+    for i_group, group in enumerate(split["groups"]):
+        selected = dose_point == i_group
+        group_tags[group] = [tag + "\n" for tag in tags[selected]]
+        if events:
+            group_events[group] = list(lines_events[selected])
+    return dose_point, group_tags, group_events
+
+
+def write_lines(filename, lines):
+    with open(filename, "w") as f:
+        f.write("".join(lines))
+
+
+def write_split(directory, split, group_tags, group_events=None):
+    """<group>.txt and events_<group>.lst files in directory. Groups not
+    processed further (not_assigned) are written only if not empty."""
+    directory = Path(directory)
+    for group in split["groups"]:
+        if group not in split["processed"] and not group_tags[group]:
+            for filename in (f"{group}.txt", f"events_{group}.lst"):
+                if (directory / filename).is_file(): (directory / filename).unlink()
+            continue
+        write_lines(directory / f"{group}.txt", group_tags[group])
+        isfile_or_touch(directory / f"{group}.txt")
+        if group_events:
+            write_lines(directory / f"events_{group}.lst", group_events[group])
+            isfile_or_touch(directory / f"events_{group}.lst")
+
+
+def create_dose_point_h5(directory, split, events=None, feature="intensity"):
+    """Splits images of a file using results in its folder and creates there:
+       * xia2.ssx: <file>_dose_point.h5
+       * CrystFEL: events_<group>.lst, e.g. events_pump.lst events_probe.lst events_not_assigned.lst
+       * <group>.txt with image tags
+       split is from dose_point_split(), applied on the column feature of
+       average_intensity.npy (default: the average intensity). The dose
+       point of every image is also stored in the column group of
+       average_intensity.npy. Returns image tags and event lines (if events
+       are given) of all groups as two dictionaries."""
+    directory = Path(directory)
+    table = np.asarray(load_results(str(directory / "average_intensity")))
+    # tables of older versions have a narrower column group
+    table = table.astype(table_dtype(table.dtype))
+    if table.size:
+        print(f"File {table['run'][0].decode()}")
+    dose_point, group_tags, group_events = split_images(table, split, events, feature)
+    table["group"] = dose_point
+    write_table(directory / "average_intensity.npy", table)
+    write_split(directory, split, group_tags, group_events)
+    name = directory.resolve().name
+    with h5py.File(directory / f"{name}_dose_point.h5", 'w') as f:
+        f.create_dataset("dose_point", data=dose_point)
+    print(f"File created: {name}/{name}_dose_point.h5")
+    print("")
+    return group_tags, group_events
+
+
+def frame_segments(frames):
+    """Sorted frames as arithmetic progressions (first, step, count) -
+    e.g. every other frame of interleaved pump and probe images is a
+    single segment"""
+    frames = np.asarray(frames, dtype=np.int64)
+    if not frames.size:
+        return []
+    diffs = np.diff(frames)
+    # positions where the difference between frames changes
+    changes = np.flatnonzero(diffs[1:] != diffs[:-1]) + 1
+    segments = []
+    i = 0
+    while i < frames.size:
+        if i == frames.size - 1:
+            segments.append((int(frames[i]), 1, 1))
+            break
+        k = np.searchsorted(changes, i, side="right")
+        end = changes[k] if k < changes.size else diffs.size  # the last frame of the segment
+        segments.append((int(frames[i]), int(diffs[i]), int(end - i + 1)))
+        i = end + 1
+    return segments
+
+
+def write_group_vds(filename, h5_file, frames, dataset=H5_DATASET, dose_point=None):
+    """HDF5 file with the selected frames of h5_file as virtual datasets -
+    no data are copied. Every dataset with a value per frame (the same
+    first dimension as dataset, e.g. /data/data) becomes a virtual dataset
+    of the selected frames, other datasets are external links to h5_file,
+    attributes are copied. If dose_point is given, it is stored as
+    /dose_point for all frames."""
+    h5_file = os.path.abspath(h5_file)
+    segments = frame_segments(frames)
+    n = sum(count for start, step, count in segments)
+    with h5py.File(h5_file, "r") as source, h5py.File(filename, "w") as vds:
+        n_frames = source[dataset].shape[0]
+
+        def mirror(name, o):
+            if isinstance(o, h5py.Group):
+                vds.require_group(name).attrs.update(o.attrs)
+            elif o.ndim and o.shape[0] == n_frames:
+                layout = h5py.VirtualLayout(shape=(n,) + o.shape[1:], dtype=o.dtype)
+                vsource = h5py.VirtualSource(h5_file, name, shape=o.shape)
+                i = 0
+                for start, step, count in segments:
+                    # a strided hyperslab - one mapping for a regular pattern of frames
+                    layout[i:i + count] = vsource[start:start + step * (count - 1) + 1:step]
+                    i += count
+                vds.create_virtual_dataset(name, layout, fillvalue=0).attrs.update(o.attrs)
+            else:
+                vds[name] = h5py.ExternalLink(h5_file, name)
+
+        vds.attrs.update(source.attrs)
+        source.visititems(mirror)
+        if dose_point is not None:
+            vds.create_dataset("dose_point", data=np.full(n, dose_point, dtype=np.int64))
+    return filename
+
+
+def dials_phil(geom=None, mask=None, spacegroup=None, cell=None, d_min=None):
+    """Common part of run_dials.phil for dials.stills_process"""
+    phil = f"""spotfinder.filter.min_spot_size=2
+spotfinder.filter.max_spot_size=10
+#significance_filter.enable=True
+#significance_filter.isigi_cutoff=1.0
+mp.nproc = 20
+mp.method=multiprocessing
+#refinement.parameterisation.detector.fix=none"""
+    if geom: phil += f"\ninput.reference_geometry={geom}"
+    if mask:
+        phil += f"\nspotfinder.lookup.mask={mask}"
+        phil += f"\nintegration.lookup.mask={mask}"
+    phil += """
+indexing {
+  stills.indexer=stills
+  stills.method_list=fft1d real_space_grid_search
+  multiple_lattice_search.max_lattices=3"""
+    if spacegroup and cell:
+        phil += """
+  known_symmetry {
+    space_group = """ + spacegroup + """
+     unit_cell = """ + ", ".join(str(c) for c in cell) + """
+  }"""
+    phil += "\n}"
+    if d_min:
+        phil += f"\nspotfinder.filter.d_min={d_min}\n"
+    return phil
+
+
+def write_dials_job(directory, h5_file, tags, phil, source_dials=""):
+    """run_dials.phil and run_dials.sh processing the images with given
+    tags in directory (e.g. pump/job_001), all images of h5_file if
+    tags is None (e.g. a file from write_group_vds). h5_file can be also
+    a list of files."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / "run_dials.phil", "w") as r:
+        r.write(phil.rstrip("\n") + "\n")
+        if tags is not None:
+            r.write("".join(f"input.image_tag={tag.rstrip()}\n" for tag in tags))
+    with open(directory / "run_dials.sh", "w") as r:
+        r.write(f"{source_dials}\n" "dials.stills_process run_dials.phil ")
+        r.write(h5_file if isinstance(h5_file, str) else " ".join(str(f) for f in h5_file))
+    return directory / "run_dials.sh"
+
+
+def write_reduce_job(directory, dials_dirs, source_dials=""):
+    """run_xia2_reduce.sh in directory (e.g. pump) merging results of
+    dials.stills_process from dials_dirs (e.g. pump/job_001 ...)"""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / "run_xia2_reduce.sh", "w") as r:
+        r.write(source_dials + "\n")
+        r.write("xia2.ssx_reduce ")
+        for d in dials_dirs:
+            r.write(os.path.relpath(d, directory) + "/idx-*_integrated*.{expt,refl} ")
+    return directory / "run_xia2_reduce.sh"
+
+
+def job_size(group_frames, n_jobs):
+    """Number of frames per dials.stills_process job so that all groups
+    together make about n_jobs jobs. group_frames - {group: {file: frames}}"""
+    total = sum(len(frames) for files in group_frames.values() for frames in files.values())
+    return max(1, -(-total // max(1, n_jobs)))
+
+
+def pack_frames(file_frames, frames_per_job):
+    """Frames of a group ({file: frames}) cut to jobs of nearly equal size,
+    at most frames_per_job - small files are merged, big ones are cut.
+    Returns a list of jobs, every job is a list of (file, frames)."""
+    names = list(file_frames)
+    lengths = np.array([len(file_frames[f]) for f in names], dtype=np.int64)
+    total = int(lengths.sum())
+    if not total:
+        return []
+    n_jobs = -(-total // frames_per_job)
+    bounds = np.linspace(0, total, n_jobs + 1).round().astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    jobs = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        job = []
+        for f, offset, length in zip(names, offsets, lengths):
+            low, high = max(start, offset), min(stop, offset + length)
+            if low < high:
+                job.append((f, np.asarray(file_frames[f])[low - offset:high - offset]))
+        jobs.append(job)
+    return jobs
+
+
+def write_dials_jobs(directory, path, jobs, phil, dataset=H5_DATASET, image_tags=False, source_dials="", sources=None):
+    """Folders job_001, job_002 ... in directory (e.g. pump) with
+    run_dials.phil and run_dials.sh for every job from pack_frames. The
+    frames of every file are given as a virtual dataset, or by image tags
+    if image_tags. sources - {file: (its group VDS from write_group_vds,
+    frames of the group)}: a job maps a contiguous part of the group VDS
+    instead of the frames of the cheetah file again. Returns the folders."""
+    directory = Path(directory)
+    dials_dirs = []
+    for k, job in enumerate(jobs, 1):
+        job_dir = directory / f"job_{k:03d}"
+        job_dir.mkdir(parents=True, exist_ok=True)
+        for image in job_dir.glob(f"*_{directory.name}_{k:03d}.h5"):
+            image.unlink()  # from a previous run with different jobs
+        if image_tags:
+            h5_files = [h5_path(path, f) for f, frames in job]
+            tags = [frame_tag(h5_file, int(e)) for h5_file, (f, frames) in zip(h5_files, job) for e in frames]
+            write_dials_job(job_dir, h5_files, tags, phil, source_dials)
+        else:
+            images = []
+            for f, frames in job:
+                image = job_dir / f"{f}_{directory.name}_{k:03d}.h5"
+                if sources and f in sources:
+                    vds, group_frames = sources[f]
+                    images.append(write_group_vds(image, vds, np.searchsorted(group_frames, frames), dataset))
+                else:
+                    images.append(write_group_vds(image, h5_path(path, f), frames, dataset))
+            write_dials_job(job_dir, [os.path.abspath(image) for image in images], None, phil, source_dials)
+        dials_dirs.append(job_dir)
+    return dials_dirs
+
+
+def write_xia2_job(directory, path, files, geom=None, mask=None, spacegroup=None, pdb=None, d_min=None, cell=None,
+                   source_dials="", images=None):
+    """run_xia2.yml, run_xia2.sh and run_xia2.phil for xia2.ssx in directory,
+    using <file>_dose_point.h5 files in folders of individual files.
+    images - {image file: its dose point dataset} replacing the whole
+    files, e.g. files from write_group_vds with /dose_point inside."""
+    directory = Path(directory)
+    if images is None:
+        images = {f"{path}/{f}/run{f}.h5": f"{directory.resolve()}/{f}/{f}_dose_point.h5:/dose_point" for f in files}
+    with open(directory / "run_xia2.yml", "w") as r:
+        r.write(f"metadata:\n  dose_point:\n")
+        for image, dose_point in images.items():
+            r.write(f'    "{image}" : "{dose_point}"\n')
+        r.write("""grouping:
+  merge_by:
+    values:
+      - dose_point""")
+
+    with open(directory / "run_xia2.sh", "w") as r:
+        r.write(f"""{source_dials}
+xia2.ssx run_xia2.phil """ + " ".join(f"image={image}" for image in images))
+
+    with open(directory / "run_xia2.phil", "w") as r:
+        r.write(f"""spotfinding.min_spot_size=2
+spotfinding.max_spot_size=10
+grouping=run_xia2.yml""")
+        if geom: r.write(f"\nreference_geometry={geom}")
+        if mask: r.write(f"\nmask={mask}")
+        if spacegroup: r.write(f"\nspace_group={spacegroup}")
+        if pdb: r.write(f"\nreference={pdb}")
+        if d_min: r.write(f"\nd_min={d_min}")
+        if cell: r.write(f"\nindexing.unit_cell={' '.join(str(c) for c in cell)}")
+    return directory / "run_xia2.sh"
@@ -0,0 +1,239 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from pppp_api import (average_intensity_files, create_dose_point_h5, dials_phil, dose_point_split, intensity_table,
+                      job_size, pack_frames, prepare_files, write_dials_jobs, write_group_vds, write_xia2_job)
+from pppp_events import H5_DATASET, h5_path, read_events_index
+from pppp_histogram import Histogram
+from pppp_synthetic import generate, read_truth
+from pppp_table import ResultsWriter, load_results, merge_tables, write_results
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# benchmark of the hot paths on synthetic data
+#
+# For every number of frames, synthetic cheetah files are generated
+# (pppp_synthetic.py) and the stages of both scripts are timed on them
+# with the same functions the scripts use:
+#   enumeration - counting frames, tags.txt, files.lst and events.lst
+#   intensity   - average intensity of all frames and average_intensity.npy
+#   merge       - average_intensity_all.npy and the histogram
+#   split       - create_dose_point_h5 with events.lst for every file
+#   job files   - virtual datasets and dials.stills_process and xia2.ssx jobs
+# The fastest of --repeat runs is reported. Results can be saved and
+# compared with a previous run, slower stages are reported as regressions.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# dials.python pppp_benchmark.py --sizes 1000 10000 100000 1000000 --output benchmark.json
+# dials.python pppp_benchmark.py --sizes 1000 10000 --local 8 --compare benchmark.json
+# ----------------------------------------------------------------------
+
+SIZES = [1000, 10000, 100000, 1000000]
+SHAPE = (16, 16)  # small frames - the benchmark measures overheads per frame
+STAGES = ["enumeration", "intensity", "merge", "split", "job files"]
+TOLERANCE = 0.25  # relative slowdown reported as a regression
+MIN_SLOWDOWN = 0.01  # seconds, shorter differences are noise
+
+
+def timed(function, repeat=1):
+    """Shortest time of repeat calls of function and its last result.
+    Output of the function is suppressed."""
+    best = None
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_size(directory, n_frames, shape=SHAPE, n_proc=1, repeat=1, seed=0):
+    """Generate n_frames frames in three files in directory and time all
+    stages on them. Returns {stage: seconds} and the fraction of images
+    assigned to their true dose point."""
+    data = os.path.join(directory, "cheetah")
+    work = os.path.join(directory, "work")
+    os.makedirs(work, exist_ok=True)
+    files = [f"900001-{i}" for i in range(3)]
+    n_file = [len(a) for a in np.array_split(np.arange(n_frames), len(files))]
+    times = {}
+
+    times["generate"], h5_files = timed(lambda: generate(data, files, n_file, shape, seed=seed))
+    geom = os.path.join(data, "reference.expt")
+
+    times["enumeration"], (h5_files, n_file) = timed(lambda: prepare_files(work, data, files), repeat)
+
+    def intensity():
+        values = average_intensity_files(h5_files, n_file, geom, n_proc)
+        for f, v in zip(files, values):
+            write_results(os.path.join(work, f, "average_intensity"), intensity_table(f, v))
+        return values
+    times["intensity"], values = timed(intensity, repeat)
+
+    def merge():
+        histogram = Histogram(100, 200)
+        with ResultsWriter(os.path.join(work, "average_intensity_all")) as writer:
+            for chunk in merge_tables([load_results(os.path.join(work, f, "average_intensity")) for f in files]):
+                writer.write(chunk)
+                histogram.add(chunk["intensity"])
+        return histogram
+    times["merge"], histogram = timed(merge, repeat)
+
+    split = dose_point_split(30.0)
+
+    def split_files():
+        events = read_events_index(os.path.join(data, "events.lst"))
+        return {f: create_dose_point_h5(os.path.join(work, f), split, events)[0] for f in files}
+    times["split"], group_tags = timed(split_files, repeat)
+
+    def job_files():
+        group_frames = {group: {f: np.arange(n)[load_results(os.path.join(work, f, "average_intensity"))["group"]
+                                                == split["groups"].index(group)]
+                                for f, n in zip(files, n_file)}
+                        for group in split["processed"]}
+        images = {}
+        sources = {group: {} for group in split["processed"]}
+        for group in split["processed"]:
+            for f in files:
+                os.makedirs(os.path.join(work, f, group), exist_ok=True)
+                vds = os.path.join(work, f, group, f"{f}_{group}.h5")
+                images[vds] = f"{vds}:/dose_point"
+                write_group_vds(vds, h5_path(data, f), group_frames[group][f], H5_DATASET,
+                                dose_point=split["groups"].index(group))
+                sources[group][f] = (vds, group_frames[group][f])
+        write_xia2_job(work, data, files, geom, images=images)
+        phil = dials_phil(geom)
+        frames_per_job = job_size(group_frames, len(files) * len(split["processed"]))
+        return [write_dials_jobs(os.path.join(work, group), data, pack_frames(group_frames[group], frames_per_job), phil,
+                                 sources=sources[group])
+                for group in split["processed"]]
+    times["job files"], dials_dirs = timed(job_files, repeat)
+
+    dose_point = np.concatenate([load_results(os.path.join(work, f, "average_intensity"))["group"] for f in files])
+    truth = np.concatenate([read_truth(h5_file)[1] for h5_file in h5_files])
+    return times, float(np.mean(dose_point == truth)) if truth.size else 1.0
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Stages slower than in baseline by more than tolerance, as a list of
+    (n_frames, stage, seconds, baseline seconds)"""
+    regressions = []
+    for size, times in results.items():
+        for stage in STAGES:
+            old = baseline.get(size, {}).get(stage)
+            new = times.get(stage)
+            if old and new is not None and new > old * (1 + tolerance) and new - old > MIN_SLOWDOWN:
+                regressions.append((size, stage, new, old))
+    return regressions
+
+
+def print_results(results):
+    print(f"{'frames':>10} " + " ".join(f"{stage:>12}" for stage in STAGES) + f" {'frames/s':>12}")
+    for size, times in results.items():
+        total = sum(times[stage] for stage in STAGES)
+        print(f"{size:>10} " + " ".join(f"{times[stage]:12.3f}" for stage in STAGES) + f" {int(size) / total:12.0f}")
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="pppp - X-ray Pump and Probe Processing Pipeline - benchmark of all stages on synthetic data"
+    )
+    parser.add_argument(
+        "--sizes",
+        help=f"Numbers of frames (default: {' '.join(str(s) for s in SIZES)})",
+        type=int,
+        nargs="+",
+        default=SIZES,
+    )
+    parser.add_argument(
+        "--shape",
+        help=f"Size of a frame in pixels (default: {SHAPE[0]} {SHAPE[1]})",
+        type=int,
+        nargs=2,
+        default=SHAPE,
+        metavar=("slow", "fast"),
+    )
+    parser.add_argument(
+        "--local",
+        help="Number of processes calculating the average intensity (default: 1)",
+        type=int,
+        default=1,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--repeat",
+        help="Number of runs of every stage, the fastest is reported (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--dir",
+        help="Directory for the synthetic data (default: a temporary directory removed at the end)",
+        type=str,
+        dest="path",
+    )
+    parser.add_argument(
+        "--output", "-o",
+        help="Save the results to a JSON file",
+        type=str,
+    )
+    parser.add_argument(
+        "--compare",
+        help="JSON file with results of a previous run - stages which are slower now are reported as regressions",
+        type=str,
+    )
+    parser.add_argument(
+        "--tolerance",
+        help=f"Relative slowdown reported as a regression (default: {TOLERANCE})",
+        type=float,
+        default=TOLERANCE,
+    )
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)["results"]
+    directory = args.path or tempfile.mkdtemp(prefix="pppp_benchmark_")
+    results = {}
+    try:
+        for size in args.sizes:
+            print(f"Benchmark of {size} frames of {args.shape[0]} x {args.shape[1]} pixels...")
+            times, accuracy = benchmark_size(os.path.join(directory, str(size)), size, tuple(args.shape),
+                                             args.local, args.repeat)
+            results[str(size)] = times
+            print(f"  synthetic data generated in {times['generate']:.2f} s, "
+                  f"{100 * accuracy:.2f} % of images assigned to their true dose point")
+    finally:
+        if not args.path:
+            shutil.rmtree(directory, ignore_errors=True)
+    print("")
+    print("Time of stages in seconds:")
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"shape": args.shape, "local": args.local, "results": results}, f, indent=2)
+        print(f"Results saved in {args.output}")
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for size, stage, seconds, old in regressions:
+            print(f"REGRESSION: {stage} of {size} frames took {seconds:.3f} s, previously {old:.3f} s")
+        if regressions:
+            sys.exit(f"{len(regressions)} stage(s) slower than in {args.compare}")
+        print(f"No stage slower than in {args.compare} by more than {100 * args.tolerance:.0f} %")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# persistent cache of average intensities (and other features) of frames
+#
+# Results for a file are stored under a key derived from the absolute path,
+# size and modification time of the HDF5 file, content of the reference
+# geometry and parameters of the calculation - so any change of these
+# means a new calculation, otherwise the cached values are used.
+# The cache is kept next to the results (.pppp_cache in the working
+# directory), not in the home directory - home directories of shared
+# beamline accounts often have small quotas.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+
+CACHE_DIR = os.environ.get("PPPP_CACHE", ".pppp_cache")
+
+
+def file_hash(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def cache_key(h5_file, geom, dataset, n_bins, d_min=None, d_max=None, features=None, pixels=None):
+    st = os.stat(h5_file)
+    key = {
+        "file": os.path.abspath(h5_file),
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "geom": file_hash(geom),
+        "dataset": dataset,
+        "n_bins": n_bins,
+        "d_min": d_min,
+        "d_max": d_max,
+    }
+    if features:
+        key["features"] = features
+    if pixels:
+        # stride of rows - results of the earlier stride of pixels are not used
+        key["pixels"] = dict(pixels, mask=file_hash(pixels["mask"]) if pixels["mask"] else None, stride_of="rows")
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def cache_size(cache_dir=CACHE_DIR):
+    """Number of entries and their size in bytes"""
+    n = 0
+    size = 0
+    for root, dirs, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith(".npy"):
+                n += 1
+                size += os.path.getsize(os.path.join(root, name))
+    return n, size
+
+
+def _path(key, cache_dir):
+    return os.path.join(cache_dir, key[:2], key + ".npy")
+
+
+def load(key, cache_dir=CACHE_DIR):
+    """Cached values or None"""
+    path = _path(key, cache_dir)
+    if not os.path.isfile(path):
+        return None
+    try:
+        return np.load(path)
+    except (OSError, ValueError):
+        return None
+
+
+def store(key, values, cache_dir=CACHE_DIR):
+    """Save values - written to a temporary file first, so concurrent jobs
+    never see a partially written entry."""
+    path = _path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    values = np.asarray(values)
+    with open(tmp, "wb") as f:
+        np.save(f, values if values.dtype.names else values.astype(np.float64))
+    os.replace(tmp, path)
+    return path
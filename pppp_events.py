@@ -0,0 +1,165 @@
+import argparse
+import heapq
+import os
+import sys
+import h5py
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# list frames of cheetah HDF5 files - image tags and events.lst for CrystFEL
+#
+# Frames are counted from the shape of the dataset, no image is read, so
+# neither dials.stills_process show_image_tags=true nor list_events
+# from CrystFEL are needed.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# dials.python pppp_events.py --dir /path/to/cheetah/ --files 133451-0 133451-1 133451-2 -o events.lst
+# ----------------------------------------------------------------------
+
+H5_DATASET = "/data/data"  # frames stacked as (n_frames, slow, fast)
+
+
+def h5_path(path, f):
+    """Path to the cheetah file of a run, e.g. /path/to/cheetah/133451-0/run133451-0.h5"""
+    return f"{path}/{f}/run{f}.h5"
+
+
+def dataset_from_crystfel_geom(geom, default=H5_DATASET):
+    """Dataset with the frames as specified by 'data = ...' in a CrystFEL geometry file."""
+    with open(geom, "r") as f:
+        for line in f:
+            line = line.split(";")[0].strip()
+            if line.startswith("data") and "=" in line:
+                key, value = line.split("=", 1)
+                if key.strip() == "data":
+                    return value.strip()
+    return default
+
+
+def count_frames(filename, dataset=H5_DATASET):
+    """Number of frames in an HDF5 file, read from the dataset shape only."""
+    with h5py.File(filename, "r") as f:
+        return f[dataset].shape[0]
+
+
+def frame_tag(filename, event):
+    """Image tag as used in average_intensity.csv, e.g. run133451-0_000012"""
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    return f"{stem}_{event:06d}"
+
+
+def frame_tags(filename, n_frames):
+    return [frame_tag(filename, i) for i in range(n_frames)]
+
+
+def event_line(filename, event):
+    """Line of events.lst as written by list_events from CrystFEL"""
+    return f"{filename} //{event}\n"
+
+
+def tag_event(tag):
+    """File stem and event number of an image tag, e.g. ('run133451-0', 12)"""
+    stem, event = tag.rsplit("_", 1)
+    return stem, int(event)
+
+
+def line_event(line):
+    """File stem and event number of a line of events.lst, e.g.
+    ('run133451-0', 12) - 0 for lines without an event"""
+    path, sep, event = line.rstrip().partition(" //")
+    return os.path.splitext(os.path.basename(path))[0], int(event) if sep else 0
+
+
+def read_events_index(filename):
+    """Index of a CrystFEL events.lst: {file stem: {event number: line}}.
+    Lines without an event (single-event files) are stored as event 0."""
+    index = {}
+    with open(filename, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            stem, event = line_event(line)
+            index.setdefault(stem, {})[event] = line if line.endswith("\n") else line + "\n"
+    return index
+
+
+def _event_lines(filename):
+    with open(filename, "r") as f:
+        for line in f:
+            if line.strip():
+                yield line if line.endswith("\n") else line + "\n"
+
+
+def merge_events_lst(filename, inputs):
+    """events.lst merged from events lists sorted by event (as written for
+    every file) in the order of (file stem, event). Inputs are read line by
+    line, so only a line of every input is in memory. Missing inputs are
+    skipped. Returns the number of lines."""
+    sources = [_event_lines(i) for i in inputs if os.path.isfile(i)]
+    n = 0
+    with open(filename, "w") as f:
+        for line in heapq.merge(*sources, key=line_event):
+            f.write(line)
+            n += 1
+    return n
+
+
+def write_tags(filename, tags):
+    with open(filename, "w") as f:
+        f.write("".join(tag + "\n" for tag in tags))
+
+
+def write_events_lst(filename, h5_files, n_frames):
+    """events.lst for CrystFEL listing all frames of all files."""
+    with open(filename, "w") as f:
+        for h5_file, n in zip(h5_files, n_frames):
+            f.write("".join(event_line(h5_file, i) for i in range(n)))
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="pppp - X-ray Pump and Probe Processing Pipeline - list frames of cheetah HDF5 files"
+    )
+    parser.add_argument(
+        "--dir", "--path",
+        help="Absolute path to the directory with data",
+        type=str,
+        required=True,
+        dest="path"
+    )
+    parser.add_argument(
+        "--files",
+        help="Names of files to be involved in processing, e.g. 133451-0",
+        type=str,
+        required=True,
+        nargs="+"
+    )
+    parser.add_argument(
+        "--dataset",
+        help=f"Dataset with the frames (default: {H5_DATASET})",
+        type=str,
+        default=H5_DATASET,
+    )
+    parser.add_argument(
+        "--output", "-o",
+        help="Output events.lst file (default: print to standard output)",
+        type=str,
+    )
+    args = parser.parse_args()
+
+    if args.path[-1] == "/":
+        args.path = args.path[:-1]
+    h5_files = [h5_path(args.path, f) for f in args.files]
+    n_frames = [count_frames(h5_file, args.dataset) for h5_file in h5_files]
+    if args.output:
+        write_events_lst(args.output, h5_files, n_frames)
+    else:
+        for h5_file, n in zip(h5_files, n_frames):
+            sys.stdout.write("".join(event_line(h5_file, i) for i in range(n)))
+
+
+if __name__ == "__main__":
+    run()
@@ -1,21 +1,150 @@
-import sys
+import argparse
+import itertools
+import os
 import numpy as np
-import matplotlib.pyplot as plt
-from pandas import read_csv
-
-
-if len(sys.argv) > 1:
-    csvfile = sys.argv[1]
-else:
-    csvfile = 'average_intensity_all.csv'
-df = read_csv(csvfile, header=None, index_col=False, sep=',',
-              names=("runevent", "radial_average"))
-x = df["average_intensity"].to_numpy()
-n, bins, patches = plt.hist(x, 180, density=True, facecolor='g', alpha=0.75)
-plt.xlim([0, 90])
-n_images = x.size
-# plt.locator_params(nbins=9, axis='x')
-plt.xlabel('Average total scattered intensity')
-plt.grid(True)
-plt.title('Number of images used: ' + str(n_images))
-plt.savefig('average_intensity_all.png', bbox_inches="tight", dpi=200)
+from pppp_table import read_table
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# histogram of average total scattered intensity
+#
+# Average intensities are read in chunks - from the memory-mapped table
+# average_intensity_all.npy or from a CSV file - and added to counts in
+# fixed bins, so the memory needed does not depend on the number of
+# images. The counts are saved in a small CSV file, matplotlib is
+# imported only to plot them.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# dials.python pppp_histogram.py
+# dials.python pppp_histogram.py average_intensity_all.npy --max 100 --n_bins 200 --output average_intensity_all.png
+# ----------------------------------------------------------------------
+
+HISTOGRAM_MAX = 90
+N_BINS = 180
+CHUNK_SIZE = 1 << 20  # number of values added at once
+
+
+class Histogram:
+    """Counts of values in n_bins equal bins between 0 and maximum. Values
+    outside the range are counted separately, NaN values are skipped."""
+    def __init__(self, maximum=HISTOGRAM_MAX, n_bins=N_BINS):
+        self.edges = np.linspace(0, maximum, n_bins + 1)
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    @property
+    def n_images(self):
+        return int(self.counts.sum()) + self.underflow + self.overflow
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        n_bins = self.counts.size
+        i = np.floor((values - self.edges[0]) * (n_bins / (self.edges[-1] - self.edges[0])))
+        below = i < 0
+        above = i >= n_bins
+        self.underflow += int(below.sum())
+        self.overflow += int(above.sum())
+        self.counts += np.bincount(i[~(below | above)].astype(np.intp), minlength=n_bins)
+        return self
+
+    def write(self, filename):
+        """Counts as CSV: lower edge,upper edge,number of images"""
+        with open(filename, "w") as f:
+            f.write("".join(f"{low:g},{high:g},{n}\n" for low, high, n in zip(self.edges[:-1], self.edges[1:], self.counts)))
+        return filename
+
+    def plot(self, outputplot):
+        """Plot the histogram to a PNG file, None if matplotlib is not available"""
+        try:
+            import matplotlib
+            matplotlib.use("Agg")
+            import matplotlib.pyplot as plt
+        except ImportError:
+            print("Histogram not plotted. An error ocurred while importing matplotlib.pyplot.")
+            return None
+        plt.figure()
+        plt.hist(self.edges[:-1], self.edges, weights=self.counts, density=True, facecolor='g', alpha=0.75)
+        plt.xlim([self.edges[0], self.edges[-1]])
+        plt.locator_params(nbins=10, axis='x')
+        plt.xlabel('Average total scattered intensity')
+        plt.grid(True)
+        plt.title('Number of images used: ' + str(self.n_images))
+        plt.savefig(outputplot, bbox_inches="tight", dpi=200)
+        plt.close()
+        return outputplot
+
+
+def iter_intensity(filename, chunk_size=CHUNK_SIZE):
+    """Average intensities from a table (.npy) or CSV file in chunks"""
+    if filename.endswith(".npy"):
+        intensity = read_table(filename)["intensity"]
+        for start in range(0, intensity.size, chunk_size):
+            yield np.asarray(intensity[start:start + chunk_size])
+        return
+    with open(filename, "r") as f:
+        while True:
+            lines = [line for line in itertools.islice(f, chunk_size) if line.strip()]
+            if not lines:
+                break
+            yield np.array([line.split(",")[1] for line in lines], dtype=np.float64)
+
+
+def histogram_file(filename, maximum=HISTOGRAM_MAX, n_bins=N_BINS, chunk_size=CHUNK_SIZE):
+    histogram = Histogram(maximum, n_bins)
+    for values in iter_intensity(filename, chunk_size):
+        histogram.add(values)
+    return histogram
+
+
+def counts_filename(outputplot):
+    """average_intensity_all.png -> average_intensity_all_histogram.csv"""
+    return os.path.splitext(outputplot)[0] + "_histogram.csv"
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="pppp - X-ray Pump and Probe Processing Pipeline - histogram of average total scattered intensity"
+    )
+    parser.add_argument(
+        "inputfile",
+        help="Table (.npy) or CSV file with average intensities (default: average_intensity_all.npy)",
+        type=str,
+        nargs="?",
+        default="average_intensity_all.npy",
+    )
+    parser.add_argument(
+        "--output", "-o",
+        help="Output plot (default: average_intensity_all.png), counts are saved in a CSV file with the suffix _histogram",
+        type=str,
+        default="average_intensity_all.png",
+    )
+    parser.add_argument(
+        "--max",
+        help=f"Upper limit of the histogram (default: {HISTOGRAM_MAX})",
+        type=float,
+        default=HISTOGRAM_MAX,
+    )
+    parser.add_argument(
+        "--n_bins",
+        help=f"Number of bins (default: {N_BINS})",
+        type=int,
+        default=N_BINS,
+    )
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.inputfile) and args.inputfile.endswith(".npy"):
+        args.inputfile = args.inputfile[:-4] + ".csv"
+    histogram = histogram_file(args.inputfile, args.max, args.n_bins)
+    print(f"Number of images: {histogram.n_images} ({histogram.underflow} below and {histogram.overflow} above the range)")
+    print(f"Counts saved in {histogram.write(counts_filename(args.output))}")
+    if histogram.plot(args.output):
+        print(f"Histogram plotted to {args.output}")
+
+
+if __name__ == "__main__":
+    run()
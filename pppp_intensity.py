@@ -0,0 +1,521 @@
+import argparse
+import json
+import os
+import sys
+import numpy as np
+import pppp_cache
+from pppp_events import H5_DATASET, tag_event
+from pppp_reader import READ_THREADS, read_frames
+from pppp_table import export_csv, make_table, table_tags, write_table
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# average total scattered intensity of every frame of a cheetah HDF5 file
+#
+# In-process replacement of dxtbx.radial_average: the radial bin of every
+# pixel is calculated only once from the reference geometry, the frames
+# are then read in chunks of about 64 MB (pppp_reader.py) and reduced
+# with NumPy frame by frame, so only a single frame is converted to float.
+#
+# Optionally, more features of every frame are calculated from the same
+# chunk while it is in memory - mean intensity in resolution bands and
+# their ratio (--bands), number of bright pixels (--bright) and a coarse
+# radial profile (--profile-bins). They are added as columns to the
+# table average_intensity.npy and pppp2.py can split the images on them.
+#
+# The classification does not need every pixel: only a region of
+# interest (--roi, --mask) and/or every n-th row of pixels (--stride) can
+# be used. Only the rows of the frames with pixels used are read
+# (pppp_reader.py), fewer pixels are reduced - e.g. --stride 10 uses 10 %
+# of pixels evenly spread over the detector and reads only every 10th row
+# of uncompressed frames. Compressed chunks hold whole frames, so they are
+# still decompressed in full, only the reduction is faster.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# dials.python pppp_intensity.py --geom /path/to/refined.expt /path/to/cheetah/133451-0/run133451-0.h5
+# dials.python pppp_intensity.py --geom /path/to/refined.expt --tags tags.txt --output average_intensity.npy --csv average_intensity.csv \
+#     /path/to/cheetah/133451-0/run133451-0.h5
+# dials.python pppp_intensity.py --geom /path/to/refined.expt --output average_intensity.npy --bands 20 6 3 --bright 1000 \
+#     --profile-bins 50 /path/to/cheetah/133451-0/run133451-0.h5
+# dials.python pppp_intensity.py --geom /path/to/refined.expt --output average_intensity.npy --roi 0 1000 200 800 --stride 10 \
+#     /path/to/cheetah/133451-0/run133451-0.h5
+# ----------------------------------------------------------------------
+
+CHUNK_SIZE = None  # number of frames read at once, None - by pppp_reader.BLOCK_BYTES
+N_BINS = 2500  # the same default as dxtbx.radial_average
+
+
+def _frame(node):
+    return tuple(np.array(node[k], dtype=float) for k in ("fast_axis", "slow_axis", "origin"))
+
+
+def _global_frame(parent, local):
+    """Place a frame given relative to its parent in the lab frame."""
+    fast, slow, origin = parent
+    r = np.array([fast, slow, np.cross(fast, slow)]).T
+    return r @ local[0], r @ local[1], origin + r @ local[2]
+
+
+def load_reference_geometry(filename):
+    """Read the beam and the detector panels of the first experiment in
+    a DIALS experiment list (.expt). Panel frames are returned in the lab
+    frame, i.e. the detector hierarchy is already applied."""
+    with open(filename, "r") as f:
+        expt = json.load(f)
+    i_beam = 0
+    i_detector = 0
+    if expt.get("experiment"):
+        i_beam = expt["experiment"][0].get("beam", 0)
+        i_detector = expt["experiment"][0].get("detector", 0)
+    beam = expt["beam"][i_beam]
+    detector = expt["detector"][i_detector]
+    panels = detector["panels"]
+
+    frames = [None] * len(panels)
+    def walk(node, parent):
+        if "panel" in node:
+            frames[node["panel"]] = _global_frame(parent, _frame(panels[node["panel"]]))
+            return
+        frame = _global_frame(parent, _frame(node))
+        for child in node.get("children", []):
+            walk(child, frame)
+    if "hierarchy" in detector:
+        walk(detector["hierarchy"], (np.array([1.0, 0, 0]), np.array([0, 1.0, 0]), np.zeros(3)))
+    for i, panel in enumerate(panels):
+        if frames[i] is None:
+            frames[i] = _frame(panel)
+
+    geometry = {
+        "wavelength": float(beam["wavelength"]),
+        "direction": np.array(beam["direction"], dtype=float),
+        "panels": [],
+    }
+    for i, panel in enumerate(panels):
+        geometry["panels"].append({
+            "d_matrix": np.array(frames[i]).T,  # columns fast, slow, origin
+            "pixel_size": tuple(panel["pixel_size"]),
+            "image_size": tuple(panel["image_size"]),  # (fast, slow)
+            "trusted_range": tuple(panel.get("trusted_range", (-np.inf, np.inf))),
+        })
+    return geometry
+
+
+def panel_two_theta(panel, direction):
+    """Scattering angle (radians) of the centre of every pixel of a panel."""
+    n_fast, n_slow = panel["image_size"]
+    px_fast, px_slow = panel["pixel_size"]
+    x = (np.arange(n_fast) + 0.5) * px_fast
+    y = (np.arange(n_slow) + 0.5) * px_slow
+    xx, yy = np.meshgrid(x, y)  # shape (slow, fast)
+    xy1 = np.stack((xx, yy, np.ones_like(xx)), axis=-1)
+    lab = xy1 @ panel["d_matrix"].T
+    s = -direction / np.linalg.norm(direction)
+    cos_two_theta = (lab @ s) / np.linalg.norm(lab, axis=-1)
+    return np.arccos(np.clip(cos_two_theta, -1, 1))
+
+
+class RadialIndex:
+    """Radial bin of every pixel of a flattened frame, pixels outside the
+    resolution range or masked out are not stored at all."""
+    def __init__(self, pixels, bins, n_bins, n_pixels, trusted_range, d_spacing=None, width=None, row_step=1):
+        self.pixels = pixels  # positions in the flattened frame
+        self.bins = bins  # radial bin of each of these pixels
+        self.n_bins = n_bins
+        self.n_pixels = n_pixels
+        self.trusted_range = trusted_range
+        self.d_spacing = d_spacing  # resolution of the centre of every radial bin
+        self.width = width  # pixels in a row of the frame
+        self.rows = None  # (first, stop, step) rows with the pixels
+        self._row_pixels = None
+        if width:
+            self.rows = (int(pixels[0]) // width, int(pixels[-1]) // width + 1, int(row_step))
+
+    def frame_pixels(self, n_pixels):
+        """Positions of the pixels in frames of n_pixels pixels - whole
+        frames or only the rows with the pixels"""
+        if n_pixels == self.n_pixels:
+            return self.pixels
+        if self.rows and n_pixels == len(range(*self.rows)) * self.width:
+            if self._row_pixels is None:
+                first, stop, step = self.rows
+                self._row_pixels = (self.pixels // self.width - first) // step * self.width + self.pixels % self.width
+            return self._row_pixels
+        raise ValueError(f"Frames have {n_pixels} pixels but the reference geometry has {self.n_pixels}")
+
+
+def build_radial_index(geometry, n_bins=N_BINS, d_min=None, d_max=None, mask=None, roi=None, stride=1):
+    """Assign a radial (two-theta) bin to every pixel of the detector.
+
+    Panels are expected in the file one after another along the slow axis
+    as cheetah writes them. Pixels with d-spacing outside d_min - d_max,
+    False in the optional boolean mask (same shape as a frame) or outside
+    roi (slow_start, slow_stop, fast_start, fast_stop) are excluded. Of
+    the remaining pixels, only those in every stride-th row (from the
+    first row of the roi) are used, so the other rows need not be read."""
+    two_theta = np.concatenate(
+        [panel_two_theta(p, geometry["direction"]).ravel() for p in geometry["panels"]])
+    n_pixels = two_theta.size
+    selected = np.ones(n_pixels, dtype=bool)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool).ravel()
+        if mask.size != n_pixels:
+            raise ValueError(f"Mask has {mask.size} pixels but the detector has {n_pixels}")
+        selected &= mask
+    width = geometry["panels"][0]["image_size"][0]
+    if roi is not None:
+        in_roi = np.zeros((n_pixels // width, width), dtype=bool)
+        in_roi[roi[0]:roi[1], roi[2]:roi[3]] = True
+        selected &= in_roi.ravel()
+    if stride > 1:
+        in_rows = np.zeros(n_pixels // width, dtype=bool)
+        in_rows[roi[0] if roi is not None else 0::stride] = True
+        selected &= np.repeat(in_rows, width)
+    with np.errstate(divide="ignore"):
+        d = geometry["wavelength"] / (2 * np.sin(two_theta / 2))
+    if d_min:
+        selected &= d >= d_min
+    if d_max:
+        selected &= d <= d_max
+    pixels = np.flatnonzero(selected)
+    if pixels.size == 0:
+        raise ValueError("No pixels left after applying the resolution range, mask and ROI")
+    tt = two_theta[pixels]
+    tt_min = tt.min()
+    tt_max = tt.max()
+    bins = ((tt - tt_min) / (tt_max - tt_min + 1e-12) * n_bins).astype(np.intp)
+    bins = np.minimum(bins, n_bins - 1)
+    trusted_low = max(p["trusted_range"][0] for p in geometry["panels"])
+    trusted_high = min(p["trusted_range"][1] for p in geometry["panels"])
+    centres = tt_min + (np.arange(n_bins) + 0.5) * (tt_max - tt_min) / n_bins
+    with np.errstate(divide="ignore"):
+        d_spacing = geometry["wavelength"] / (2 * np.sin(centres / 2))
+    return RadialIndex(pixels, bins, n_bins, n_pixels, (trusted_low, trusted_high), d_spacing, width, stride)
+
+
+def pixel_config(roi=None, stride=1, mask=None):
+    """Pixels used, None if all: roi - slow_start slow_stop fast_start
+    fast_stop in the frame, stride - every stride-th row, mask - .npy
+    file with a boolean array of the shape of a frame (True - used)"""
+    if roi is not None and len(roi) != 4:
+        raise ValueError("ROI is given by four numbers: slow_start slow_stop fast_start fast_stop")
+    if stride < 1:
+        raise ValueError("Pixel stride has to be at least 1")
+    if roi is None and stride == 1 and mask is None:
+        return None
+    return {
+        "roi": [int(r) for r in roi] if roi is not None else None,
+        "stride": int(stride),
+        "mask": os.path.abspath(mask) if mask else None,
+    }
+
+
+def pixel_options(pixels):
+    """Arguments of this script selecting the pixels"""
+    if not pixels:
+        return ""
+    options = ""
+    if pixels["roi"] is not None:
+        options += " --roi " + " ".join(str(r) for r in pixels["roi"])
+    if pixels["stride"] != 1:
+        options += f" --stride {pixels['stride']}"
+    if pixels["mask"]:
+        options += f" --mask {pixels['mask']}"
+    return options
+
+
+def pixel_index(geometry, pixels=None, n_bins=N_BINS, d_min=None, d_max=None):
+    """Radial index of the pixels from pixel_config"""
+    if not pixels:
+        return build_radial_index(geometry, n_bins, d_min, d_max)
+    mask = np.load(pixels["mask"]) if pixels["mask"] else None
+    return build_radial_index(geometry, n_bins, d_min, d_max, mask, pixels["roi"], pixels["stride"])
+
+
+def feature_config(bands=None, bright=None, profile_bins=0):
+    """Features calculated besides the average intensity, None if none:
+       * bands - resolution (d-spacing) edges of bands, e.g. [20, 6, 3]
+         gives the mean intensity in bands band0 (20 - 6 A), band1 (6 - 3 A)
+         and band_ratio = band0 / band1 (the first over the last band)
+       * bright - pixels with this value or higher are counted as n_bright
+       * profile_bins - radial profile averaged to this number of bins"""
+    if bands is not None and len(bands) < 2:
+        raise ValueError("At least two edges of resolution bands are needed")
+    if not bands and bright is None and not profile_bins:
+        return None
+    return {
+        "bands": sorted((float(d) for d in bands), reverse=True) if bands else [],
+        "bright": bright,
+        "profile_bins": int(profile_bins or 0),
+    }
+
+
+def feature_options(features):
+    """Arguments of this script calculating the features"""
+    if not features:
+        return ""
+    options = ""
+    if features["bands"]:
+        options += " --bands " + " ".join(str(d) for d in features["bands"])
+    if features["bright"] is not None:
+        options += f" --bright {features['bright']}"
+    if features["profile_bins"]:
+        options += f" --profile-bins {features['profile_bins']}"
+    return options
+
+
+def feature_dtype(features):
+    """Structured dtype of features of a frame, the average intensity first"""
+    fields = [("intensity", np.float64)]
+    n_bands = max(0, len(features["bands"]) - 1)
+    fields += [(f"band{i}", np.float64) for i in range(n_bands)]
+    if n_bands > 1:
+        fields.append(("band_ratio", np.float64))
+    if features["bright"] is not None:
+        fields.append(("n_bright", np.int64))
+    if features["profile_bins"]:
+        fields.append(("profile", np.float64, (features["profile_bins"],)))
+    return np.dtype(fields)
+
+
+def _radial_sums(frames, index, bright=None):
+    """Sums and counts of valid pixels in every radial bin of every frame
+    and numbers of valid pixels with value bright or higher (if given).
+    Frames are reduced one by one with the bins of the index as they are,
+    so only the pixels of one frame are held as floats at a time."""
+    n = frames.shape[0]
+    frames = frames.reshape(n, -1)
+    pixels = index.frame_pixels(frames.shape[1])
+    low, high = index.trusted_range
+    sums = np.empty((n, index.n_bins))
+    counts = np.empty((n, index.n_bins))
+    n_bright = np.zeros(n, dtype=np.int64)
+    for i in range(n):
+        values = frames[i, pixels].astype(np.float64, copy=False)
+        valid = (values > low) & (values < high)
+        if bright is not None:
+            n_bright[i] = np.count_nonzero(valid & (values >= bright))
+        values = np.where(valid, values, 0)
+        sums[i] = np.bincount(index.bins, weights=values, minlength=index.n_bins)
+        counts[i] = np.bincount(index.bins, weights=valid, minlength=index.n_bins)
+    return sums, counts, n_bright
+
+
+def _mean(sums, counts):
+    return np.divide(sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0)
+
+
+def _profile_average(sums, counts):
+    populated = counts > 0
+    profile = np.divide(sums, counts, out=np.zeros_like(sums), where=populated)
+    n_populated = populated.sum(axis=1)
+    return np.divide(profile.sum(axis=1), n_populated,
+                     out=np.full(sums.shape[0], np.nan), where=n_populated > 0)
+
+
+def average_intensity(frames, index):
+    """Average of the radial profile of each frame in an array of shape
+    (n_frames, ...) - the value reported as 'Average' by dxtbx.radial_average."""
+    sums, counts, n_bright = _radial_sums(frames, index)
+    return _profile_average(sums, counts)
+
+
+def frame_features(frames, index, features):
+    """Average intensity and features (from feature_config) of each frame
+    as a structured array (feature_dtype) - all from a single pass over
+    the pixels."""
+    sums, counts, n_bright = _radial_sums(frames, index, features["bright"])
+    result = np.zeros(frames.shape[0], dtype=feature_dtype(features))
+    result["intensity"] = _profile_average(sums, counts)
+    edges = features["bands"]
+    if len(edges) > 1:
+        band = np.digitize(index.d_spacing, edges) - 1  # edges are descending
+        for i in range(len(edges) - 1):
+            in_band = band == i
+            result[f"band{i}"] = _mean(sums[:, in_band].sum(axis=1), counts[:, in_band].sum(axis=1))
+        if len(edges) > 2:
+            result["band_ratio"] = _mean(result["band0"], result[f"band{len(edges) - 2}"])
+    if features["bright"] is not None:
+        result["n_bright"] = n_bright
+    if features["profile_bins"]:
+        n_bins = min(features["profile_bins"], index.n_bins)
+        starts = np.arange(n_bins) * index.n_bins // n_bins
+        result["profile"][:, :n_bins] = _mean(np.add.reduceat(sums, starts, axis=1),
+                                              np.add.reduceat(counts, starts, axis=1))
+        result["profile"][:, n_bins:] = np.nan
+    return result
+
+
+def iter_frames(filename, dataset=H5_DATASET, chunk_size=CHUNK_SIZE, start=0, stop=None, threads=READ_THREADS, rows=None):
+    """Yield (frame index, frames) in chunks of frames, optionally only
+    for the frames start:stop and rows (first, stop, step) of every frame."""
+    yield from read_frames(filename, dataset, chunk_size, start, stop, threads, rows)
+
+
+def average_intensity_h5(filename, index, dataset=H5_DATASET, chunk_size=CHUNK_SIZE, start=0, stop=None, features=None,
+                         threads=READ_THREADS):
+    """Average intensity of every frame (or of frames start:stop) of an HDF5 file.
+    If features (from feature_config) are given, an array of features
+    (feature_dtype) is returned instead. Only the rows of frames with
+    pixels of the index are read, by threads threads."""
+    result = []
+    for i, frames in iter_frames(filename, dataset, chunk_size, start, stop, threads, index.rows):
+        result.append(frame_features(frames, index, features) if features else average_intensity(frames, index))
+    if not result:
+        return np.array([], dtype=feature_dtype(features) if features else np.float64)
+    return np.concatenate(result)
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="pppp - X-ray Pump and Probe Processing Pipeline - average total scattered intensity of every frame"
+    )
+    parser.add_argument(
+        "file",
+        help="HDF5 file with diffraction images",
+        type=str,
+    )
+    parser.add_argument(
+        "--geom",
+        help="Absolute path to a geometry file for DIALS or xia2",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--tags",
+        help="File with image tags, one per line, in the order of the frames",
+        type=str,
+    )
+    parser.add_argument(
+        "--output", "-o",
+        help="Output file - table average_intensity.npy or a CSV file (default: print CSV to standard output)",
+        type=str,
+    )
+    parser.add_argument(
+        "--csv",
+        help="Export also a CSV file for humans",
+        type=str,
+    )
+    parser.add_argument(
+        "--dataset",
+        help=f"Dataset with the frames (default: {H5_DATASET})",
+        type=str,
+        default=H5_DATASET,
+    )
+    parser.add_argument(
+        "--chunk",
+        help="Number of frames read at once (default: about 64 MB of frames)",
+        type=int,
+        default=CHUNK_SIZE,
+    )
+    parser.add_argument(
+        "--n_bins",
+        help=f"Number of radial bins (default: {N_BINS})",
+        type=int,
+        default=N_BINS,
+    )
+    parser.add_argument(
+        "--d_min",
+        help="High-resolution limit of pixels involved",
+        type=float,
+    )
+    parser.add_argument(
+        "--d_max",
+        help="Low-resolution limit of pixels involved",
+        type=float,
+    )
+    parser.add_argument(
+        "--roi",
+        help="Use only pixels in this region of the frame (rows and columns as stored in the file)",
+        type=int,
+        nargs=4,
+        metavar=("slow_start", "slow_stop", "fast_start", "fast_stop"),
+    )
+    parser.add_argument(
+        "--stride",
+        help="Use only every N-th row of pixels, e.g. 10 for 10 %% of pixels - only these rows are read (default: 1 - all)",
+        type=int,
+        default=1,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--mask",
+        help="Use only pixels True in a boolean array of the shape of a frame saved in a .npy file",
+        type=str,
+    )
+    parser.add_argument(
+        "--threads",
+        help=f"Number of threads reading and decompressing the frames (default: {READ_THREADS})",
+        type=int,
+        default=READ_THREADS,
+    )
+    parser.add_argument(
+        "--cache",
+        help="Directory with cached results - used if the file has been processed already, updated otherwise",
+        type=str,
+    )
+    parser.add_argument(
+        "--bands",
+        help="Resolution (A) edges of bands, e.g. 20 6 3 - mean intensity in every band and the ratio of the first and the last band are added to the table",
+        type=float,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--bright",
+        help="Pixels with this value or higher are counted (column n_bright of the table)",
+        type=float,
+    )
+    parser.add_argument(
+        "--profile-bins",
+        help="Radial profile averaged to this number of bins is added to the table (column profile)",
+        type=int,
+        default=0,
+        dest="profile_bins",
+    )
+    args = parser.parse_args()
+
+    try:
+        features = feature_config(args.bands, args.bright, args.profile_bins)
+        pixels = pixel_config(args.roi, args.stride, args.mask)
+    except ValueError as e:
+        sys.exit(str(e))
+    values = None
+    if args.cache:
+        key = pppp_cache.cache_key(args.file, args.geom, args.dataset, args.n_bins, args.d_min, args.d_max, features,
+                                   pixels)
+        values = pppp_cache.load(key, args.cache)
+    if values is None:
+        geometry = load_reference_geometry(args.geom)
+        try:
+            index = pixel_index(geometry, pixels, args.n_bins, args.d_min, args.d_max)
+        except ValueError as e:
+            sys.exit(str(e))
+        values = average_intensity_h5(args.file, index, args.dataset, args.chunk, features=features,
+                                      threads=args.threads)
+        if args.cache:
+            pppp_cache.store(key, values, args.cache)
+    if args.tags:
+        with open(args.tags, "r") as f:
+            events = [tag_event(line.split()[0])[1] for line in f if line.strip()]
+        if len(events) != values.size:
+            print(f"WARNING: {len(events)} image tags but {values.size} frames in {args.file}")
+            events = events[:values.size]
+            values = values[:len(events)]
+    else:
+        events = np.arange(values.size)
+    run = os.path.splitext(os.path.basename(args.file))[0]
+    table = make_table(run[3:] if run.startswith("run") else run, events, values)
+    if args.output and args.output.endswith(".npy"):
+        write_table(args.output, table)
+    elif args.output:
+        export_csv(args.output, table)
+    else:
+        sys.stdout.write("".join(f"{tag},{value:.4f}\n" for tag, value in zip(table_tags(table), table["intensity"])))
+    if args.csv:
+        export_csv(args.csv, table)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,389 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import select
+import subprocess
+import threading
+import time
+from pppp_timing import read_sentinel
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# submission of jobs to a batch system
+#
+# Every stage is submitted as a single array job - task i runs a script
+# in the i-th directory (run or run/group). QsubScheduler talks to
+# qsub/qstat, LocalScheduler runs the same scripts as local processes
+# and stands in for the queue when testing.
+#
+# Completion of jobs is followed by JobTracker: every task of an array
+# job writes a sentinel file when it ends (noticed via inotify if
+# available, otherwise by a cheap stat), the scheduler is asked only
+# once per period about all outstanding jobs together. A task whose
+# sentinel has a non-zero exit code (or which ended without a sentinel)
+# has failed - it is reported in JobTracker.failed, not as finished.
+#
+# Stages can be described as a JobGraph and submitted up front, the
+# batch system then starts every job when its dependencies are done
+# (qsub -hold_jid) and the driver does not need to wait. The graph is
+# submitted with asyncio - jobs whose dependencies already have ids are
+# submitted concurrently (at most max_concurrent qsub calls at once).
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+
+QSUB_OPTIONS = ['-pe', 'smp', '20']
+MAX_CONCURRENT = 8  # qsub calls running at the same time
+SENTINEL_DIR = ".pppp_done"  # sentinel files written by tasks of array jobs
+
+
+def make_executable(filename):
+    """chmod +x without starting a process"""
+    os.chmod(filename, os.stat(filename).st_mode | 0o111)
+    return filename
+
+
+def _sentinel(filename):
+    """Sentinels of a script are in SENTINEL_DIR next to it"""
+    filename = os.path.abspath(filename)
+    return os.path.join(os.path.dirname(filename), SENTINEL_DIR, os.path.basename(filename))
+
+
+def array_sentinels(filename, n_tasks):
+    """Sentinel files written by the tasks 1..n_tasks of an array job script."""
+    return [f"{_sentinel(filename)}.{task}" for task in range(1, n_tasks + 1)]
+
+
+def write_array_script(filename, task_dirs, script):
+    """Script of an array job: task i (SGE_TASK_ID, from 1) runs script in
+    task_dirs[i - 1] and then writes its exit code, start and end time
+    to a sentinel file."""
+    sentinel = _sentinel(filename)
+    os.makedirs(os.path.dirname(sentinel), exist_ok=True)
+    for s in array_sentinels(filename, len(task_dirs)):
+        if os.path.isfile(s): os.remove(s)
+    with open(filename, "w") as f:
+        f.write("#!/bin/bash\n")
+        f.write("DIRS=(\n")
+        f.write("".join(f'"{os.path.abspath(d)}"\n' for d in task_dirs))
+        f.write(")\n")
+        f.write("START=$(date +%s.%N)\n")
+        f.write(f'cd "${{DIRS[$((SGE_TASK_ID - 1))]}}" && bash {script}\n')
+        f.write(f'echo "$? $START $(date +%s.%N)" > "{sentinel}.$SGE_TASK_ID.tmp" && mv "{sentinel}.$SGE_TASK_ID.tmp" "{sentinel}.$SGE_TASK_ID"\n')
+    return make_executable(filename)
+
+
+def parse_job_id(output):
+    """Job id from the output of qsub, e.g.
+    Your job 1234 ("run_dials.sh") has been submitted
+    Your job-array 1234.1-6:1 ("run_dials_array.sh") has been submitted"""
+    return int(output.splitlines()[0].split()[2].split(".")[0])
+
+
+def parse_qstat(output):
+    """Ids of jobs listed by qstat (the first column of the job table)."""
+    job_ids = set()
+    for line in output.splitlines():
+        fields = line.split()
+        if fields and fields[0].isdigit():
+            job_ids.add(int(fields[0]))
+    return job_ids
+
+
+class Inotify:
+    """Minimal inotify watch of a directory using libc via ctypes.
+    Raises OSError where inotify is not available."""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a file to be written, returns True if it was."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class JobTracker:
+    """Follows completion of many jobs at once.
+
+    Tasks of array jobs end as soon as their sentinel files appear. The
+    scheduler is asked about all outstanding jobs in a single call - every
+    qstat_period seconds, or every period seconds if some job writes no
+    sentinels. Tasks which failed are collected in failed ({(job id,
+    task): exit code}, None if unknown). Ends of jobs and tasks are
+    recorded in timeline (pppp_timing.Timeline) if given."""
+    def __init__(self, scheduler, period=5, qstat_period=60, timeline=None):
+        self.scheduler = scheduler
+        self.period = period
+        self.qstat_period = qstat_period
+        self.timeline = timeline
+        self.pending = {}  # job id: {task: sentinel file}
+        self.failed = {}  # (job id, task): exit code
+
+    def add(self, job_id, sentinels=None):
+        """Follow a job, optionally with sentinel files of its tasks 1..n."""
+        if sentinels:
+            self.pending[job_id] = {task: s for task, s in enumerate(sentinels, 1)}
+        else:
+            self.pending[job_id] = {None: None}
+        return self
+
+    def _finished_by_sentinels(self):
+        finished = []
+        for job_id, tasks in self.pending.items():
+            for task, sentinel in tasks.items():
+                if sentinel and os.path.exists(sentinel):
+                    finished.append((job_id, task))
+        return finished
+
+    def _finished_by_scheduler(self):
+        running = self.scheduler.running(list(self.pending))
+        return [(job_id, task) for job_id, tasks in self.pending.items() if job_id not in running
+                for task in tasks]
+
+    def as_completed(self):
+        """Yield (job id, task) as soon as any of them finishes successfully, task is None
+        for non-array jobs. Failed tasks are not yielded but added to failed."""
+        inotify = None
+        sentinel_dirs = {os.path.dirname(s) for tasks in self.pending.values() for s in tasks.values() if s}
+        if len(sentinel_dirs) == 1 and os.path.isdir(next(iter(sentinel_dirs))):
+            try:
+                inotify = Inotify(next(iter(sentinel_dirs)))
+            except OSError:
+                inotify = None
+        last_qstat = time.monotonic()
+        first_cycle = True
+        try:
+            while self.pending:
+                finished = self._finished_by_sentinels()
+                qstat_period = self.qstat_period
+                if any(None in tasks for tasks in self.pending.values()):
+                    qstat_period = self.period
+                if not finished and time.monotonic() - last_qstat >= qstat_period:
+                    finished = self._finished_by_scheduler()
+                    last_qstat = time.monotonic()
+                if finished:
+                    for job_id, task in finished:
+                        sentinel = self.pending[job_id][task]
+                        # no sentinel of an array task - it was killed
+                        exit_code = read_sentinel(sentinel)[0] if sentinel else 0
+                        if self.timeline:
+                            self.timeline.finished(job_id, task, sentinel)
+                        del self.pending[job_id][task]
+                        if not self.pending[job_id]:
+                            del self.pending[job_id]
+                            print("")
+                            print("Job finished: " + str(job_id))
+                        if exit_code != 0:
+                            self.failed[(job_id, task)] = exit_code
+                            print("")
+                            print(f"WARNING: Task {task} of job {job_id} failed"
+                                  + (f" with exit code {exit_code}" if exit_code is not None else ""))
+                            continue
+                        yield job_id, task
+                    first_cycle = True
+                    continue
+                if first_cycle:
+                    print("")
+                    print("Still waiting for jobs " + " ".join(str(j) for j in self.pending), end="")
+                    first_cycle = False
+                else:
+                    print(".", end="", flush=True)
+                if inotify:
+                    inotify.wait(self.period)
+                else:
+                    time.sleep(self.period)
+        finally:
+            if inotify:
+                inotify.close()
+
+    def wait_all(self):
+        """Wait for all jobs, returns True if no task failed"""
+        for job_id, task in self.as_completed():
+            pass
+        return not self.failed
+
+
+class Scheduler:
+    """Interface of a batch system. Job ids are integers."""
+    name = None
+    detachable = True  # jobs keep running after the driver exits
+
+    def submit(self, script, n_tasks=None, options=QSUB_OPTIONS, cwd=None, hold=None):
+        """Submit a script, as an array job with tasks 1..n_tasks if n_tasks
+        is given. The job starts only after all jobs in hold have finished."""
+        raise NotImplementedError
+
+    async def submit_async(self, script, n_tasks=None, options=QSUB_OPTIONS, cwd=None, hold=None):
+        """submit() as a coroutine - by default it does not wait for anything."""
+        return self.submit(script, n_tasks=n_tasks, options=options, cwd=cwd, hold=hold)
+
+    def running(self, job_ids):
+        """Subset of job_ids that have not finished yet - a single query for all of them."""
+        raise NotImplementedError
+
+    def wait(self, job_id, sentinels=None):
+        """Block until the job (all its tasks) has finished."""
+        return JobTracker(self).add(job_id, sentinels).wait_all()
+
+
+class QsubScheduler(Scheduler):
+    name = "qsub"
+
+    @staticmethod
+    def _command(script, n_tasks, options, hold):
+        command = ['qsub'] + list(options)
+        if n_tasks:
+            command += ['-t', f'1-{n_tasks}']
+        if hold:
+            command += ['-hold_jid', ",".join(str(job_id) for job_id in hold)]
+        command.append(script)
+        return command
+
+    @staticmethod
+    def _job_id(output, err):
+        if output:
+            print(f"STDOUT: {output}")
+        if err:
+            print(f"STDERR: {err}")
+        return parse_job_id(output)
+
+    def submit(self, script, n_tasks=None, options=QSUB_OPTIONS, cwd=None, hold=None):
+        p = subprocess.Popen(
+            self._command(script, n_tasks, options, hold),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            encoding="utf-8", cwd=cwd)
+        output, err = p.communicate()
+        return self._job_id(output, err)
+
+    async def submit_async(self, script, n_tasks=None, options=QSUB_OPTIONS, cwd=None, hold=None):
+        p = await asyncio.create_subprocess_exec(
+            *self._command(script, n_tasks, options, hold),
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=cwd)
+        output, err = await p.communicate()
+        return self._job_id(output.decode("utf-8"), err.decode("utf-8"))
+
+    def running(self, job_ids):
+        p = subprocess.Popen(
+            ['qstat'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            encoding="utf-8")
+        output, err = p.communicate()
+        if p.returncode != 0:
+            print(f"STDERR: {err}")
+            return set(job_ids)  # unknown - try again next time
+        return parse_qstat(output) & set(job_ids)
+
+
+class LocalScheduler(Scheduler):
+    """Runs every task as a local bash process, options for qsub are ignored.
+    Jobs on hold are started from a thread once their dependencies end,
+    so the driver has to stay alive until all jobs have finished."""
+    name = "local"
+    detachable = False
+
+    def __init__(self):
+        self.jobs = {}  # job id: list of processes
+        self.holding = {}  # job id: thread waiting for dependencies
+        self.next_job_id = 1
+
+    def _start(self, job_id, script, n_tasks, cwd, hold):
+        for dependency in hold or []:
+            if dependency in self.holding:
+                self.holding[dependency].join()
+            for p in self.jobs.get(dependency, []):
+                p.wait()
+        for task in range(1, (n_tasks or 1) + 1):
+            env = dict(os.environ, JOB_ID=str(job_id))
+            if n_tasks:
+                env["SGE_TASK_ID"] = str(task)
+            self.jobs[job_id].append(subprocess.Popen(['bash', script], cwd=cwd, env=env))
+
+    def submit(self, script, n_tasks=None, options=QSUB_OPTIONS, cwd=None, hold=None):
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        self.jobs[job_id] = []
+        if hold:
+            thread = threading.Thread(target=self._start, args=(job_id, script, n_tasks, cwd, hold), daemon=True)
+            self.holding[job_id] = thread
+            thread.start()
+        else:
+            self._start(job_id, script, n_tasks, cwd, hold)
+        print(f"Local job {job_id} submitted: {script}" + (f" ({n_tasks} tasks)" if n_tasks else "")
+              + (f" after {' '.join(str(j) for j in hold)}" if hold else ""))
+        return job_id
+
+    def running(self, job_ids):
+        return {job_id for job_id in job_ids
+                if (job_id in self.holding and self.holding[job_id].is_alive())
+                or any(p.poll() is None for p in self.jobs.get(job_id, []))}
+
+
+class JobGraph:
+    """Jobs with dependencies, all submitted at once - every job is put on
+    hold until the jobs it depends on have finished."""
+    def __init__(self):
+        self.jobs = {}  # name: job specification, in order of addition
+
+    def add(self, name, script, n_tasks=None, options=QSUB_OPTIONS, cwd=None, after=()):
+        for dependency in after:
+            if dependency not in self.jobs:
+                raise ValueError(f"Job {name} depends on an unknown job {dependency}")
+        self.jobs[name] = {"script": script, "n_tasks": n_tasks, "options": options,
+                           "cwd": cwd, "after": list(after)}
+        return name
+
+    async def submit_async(self, scheduler, max_concurrent=MAX_CONCURRENT):
+        """Submit all jobs, returns {name: job id}. Every job is submitted as
+        soon as ids of its dependencies are known, at most max_concurrent
+        submissions run at the same time. Dependencies are always added
+        before the jobs depending on them, so no job waits for itself."""
+        semaphore = asyncio.Semaphore(max_concurrent)
+        tasks = {}
+
+        async def submit(job):
+            hold = [await tasks[dependency] for dependency in job["after"]]
+            async with semaphore:
+                return await scheduler.submit_async(job["script"], n_tasks=job["n_tasks"], options=job["options"],
+                                                    cwd=job["cwd"], hold=hold)
+
+        for name, job in self.jobs.items():
+            tasks[name] = asyncio.ensure_future(submit(job))
+        return dict(zip(tasks, await asyncio.gather(*tasks.values())))
+
+    def submit(self, scheduler, max_concurrent=MAX_CONCURRENT):
+        """submit_async() from synchronous code"""
+        return asyncio.run(self.submit_async(scheduler, max_concurrent))
+
+
+SCHEDULERS = {
+    "qsub": QsubScheduler,
+    "local": LocalScheduler,
+}
+
+
+def get_scheduler(name="qsub"):
+    return SCHEDULERS[name]()
@@ -0,0 +1,85 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from pppp_events import H5_DATASET
+from pppp_intensity import CHUNK_SIZE, average_intensity_h5, feature_dtype
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# local multi-core calculation of the average intensity - no qsub
+#
+# Frames of all files are split to tasks of a few hundred frames and spread
+# over a pool of processes. Every worker writes its results directly to
+# a NumPy array in shared memory, so nothing is sent back but a task id.
+# With features (pppp_intensity.feature_config), the array is structured.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+
+TASK_FRAMES = 256  # frames processed by a single task
+
+_worker = {}
+
+
+def split_tasks(n_frames, task_size):
+    """List of tasks (file index, first frame, stop frame, offset in the
+    result array) covering all frames of all files."""
+    tasks = []
+    offset = 0
+    for i, n in enumerate(n_frames):
+        for start in range(0, n, task_size):
+            stop = min(start + task_size, n)
+            tasks.append((i, start, stop, offset + start))
+        offset += n
+    return tasks
+
+
+def _init_worker(shm_name, n_total, h5_files, index, dataset, chunk_size, features):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker["shm"] = shm
+    _worker["result"] = np.ndarray((n_total,), dtype=feature_dtype(features) if features else np.float64, buffer=shm.buf)
+    _worker["h5_files"] = h5_files
+    _worker["index"] = index
+    _worker["dataset"] = dataset
+    _worker["chunk_size"] = chunk_size
+    _worker["features"] = features
+
+
+def _run_task(task):
+    i, start, stop, offset = task
+    # one reading thread - the processes read in parallel already
+    values = average_intensity_h5(_worker["h5_files"][i], _worker["index"], _worker["dataset"],
+                                  _worker["chunk_size"], start, stop, _worker["features"], threads=1)
+    _worker["result"][offset:offset + values.size] = values
+    return task
+
+
+def average_intensity_local(h5_files, n_frames, index, n_proc, dataset=H5_DATASET, chunk_size=CHUNK_SIZE, features=None):
+    """Average intensity of every frame of all files using n_proc processes.
+    Returns a list with an array of values for every file - of features
+    (pppp_intensity.feature_dtype) if features are given."""
+    dtype = feature_dtype(features) if features else np.dtype(np.float64)
+    n_total = int(sum(n_frames))
+    if n_total == 0:
+        return [np.array([], dtype=dtype) for n in n_frames]
+    tasks = split_tasks(n_frames, TASK_FRAMES)
+    shm = shared_memory.SharedMemory(create=True, size=n_total * dtype.itemsize)
+    try:
+        result = np.ndarray((n_total,), dtype=dtype, buffer=shm.buf)
+        if features:
+            result["intensity"] = np.nan
+        else:
+            result[:] = np.nan
+        with multiprocessing.Pool(
+                n_proc, initializer=_init_worker,
+                initargs=(shm.name, n_total, list(h5_files), index, dataset, chunk_size, features)) as pool:
+            for n_done, task in enumerate(pool.imap_unordered(_run_task, tasks), 1):
+                print(f"\rCalculated {n_done}/{len(tasks)} tasks", end="")
+        print("")
+        result = result.copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    offsets = np.cumsum([0] + list(n_frames))
+    return [result[offsets[i]:offsets[i + 1]] for i in range(len(n_frames))]
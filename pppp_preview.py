@@ -0,0 +1,262 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import h5py
+from pppp_api import classify, expand_files
+from pppp_events import H5_DATASET, count_frames, h5_path
+from pppp_histogram import Histogram, counts_filename
+from pppp_intensity import CHUNK_SIZE, average_intensity, load_reference_geometry, pixel_config, pixel_index
+from pppp_reader import block_frames
+from pppp_threshold import print_suggestion, suggest_threshold
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# preview - histogram and threshold from a sample of frames
+#
+# Frames are sampled from all files at the same rate and evenly over
+# every file (one random frame in each block of frames), so every part
+# of the data collection is represented. The sample starts at e.g. 1 %
+# of frames and is doubled in rounds - only the new frames are read. After
+# every round, the threshold is suggested again and fractions of pump
+# and probe images are estimated with a confidence interval (files are
+# strata). It stops when both the fractions are known within --error
+# (half-width of the interval) and the threshold changed less than --stable
+# times the standard deviation of the narrower of the two components of
+# the mixture fitted to the intensities - so the rule does not depend on
+# the scale of the intensity.
+# Pixels can be selected by --roi, --stride and --mask as in pppp.py, only
+# the rows of frames with these pixels are read (all of a compressed chunk
+# is decompressed though).
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# dials.python pppp_preview.py --dir /path/to/cheetah/ --files 133451 133452 --geom /path/to/refined.expt
+# dials.python pppp_preview.py --dir /path/to/cheetah/ --files 133451 --geom /path/to/refined.expt --fraction 0.005 --max-fraction 0.2
+# dials.python pppp_preview.py --dir /path/to/cheetah/ --files 133451 --geom /path/to/refined.expt --stride 10
+# ----------------------------------------------------------------------
+
+FRACTION = 0.01  # sample of the first round
+MAX_FRACTION = 0.16  # last round
+STABLE = 0.1  # change of the threshold between rounds considered stable, in sigma of the narrower component
+ERROR = 0.02  # half-width of the confidence interval of pump and probe fractions considered precise
+Z = 1.96  # 95 % confidence interval
+
+
+def stratified_frames(n, fraction, rng):
+    """One random frame from each of round(fraction * n) equal blocks of
+    frames 0..n-1, sorted."""
+    k = min(n, max(1, int(round(fraction * n)))) if n else 0
+    bounds = np.linspace(0, n, k + 1)
+    return np.unique(np.floor(bounds[:-1] + rng.random(k) * np.diff(bounds)).astype(np.int64))
+
+
+def read_intensity(h5_file, frames, index, dataset=H5_DATASET, chunk_size=CHUNK_SIZE):
+    """Average intensity of selected frames (sorted) of a file, only the
+    rows with pixels of the index are read"""
+    values = []
+    rows = slice(*index.rows) if index.rows else slice(None)
+    with h5py.File(h5_file, "r") as f:
+        data = f[dataset]
+        chunk_size = chunk_size or block_frames(data, index.rows)
+        for start in range(0, len(frames), chunk_size):
+            values.append(average_intensity(data[frames[start:start + chunk_size], rows], index))
+    return np.concatenate(values) if values else np.zeros(0)
+
+
+def stratified_fractions(samples, n_frames, threshold_low, threshold_high, z=Z):
+    """Estimated fractions of pump, probe and not assigned images in all
+    frames with half-widths of their confidence intervals. samples - an
+    array of values for every file (stratum) with n_frames frames."""
+    weights = np.asarray(n_frames, dtype=np.float64) / sum(n_frames)
+    fractions = np.zeros(3)
+    variances = np.zeros(3)
+    for values, weight, n in zip(samples, weights, n_frames):
+        if not values.size:
+            continue
+        p = np.bincount(classify(values, threshold_low, threshold_high), minlength=3)[:3] / values.size
+        fractions += weight * p
+        fpc = (n - values.size) / (n - 1) if n > 1 else 0
+        variances += weight ** 2 * p * (1 - p) / max(values.size - 1, 1) * fpc
+    return fractions, z * np.sqrt(variances)
+
+
+def preview(h5_files, n_frames, geom, dataset=H5_DATASET, fraction=FRACTION, max_fraction=MAX_FRACTION,
+            stable=STABLE, seed=None, pixels=None, error=ERROR):
+    """Average intensities of samples of frames of all files, refined in
+    rounds until the fractions of pump and probe images are known within
+    error and the suggested threshold changed less than stable sigma of
+    the narrower mixture component. Only pixels from
+    pixels (pppp_intensity.pixel_config) are used if given. Returns the
+    samples ({file: (frames, values)}) and the last suggestion (None if
+    none)."""
+    rng = np.random.default_rng(seed)
+    index = pixel_index(load_reference_geometry(geom), pixels)
+    samples = {h5_file: (np.zeros(0, dtype=np.int64), np.zeros(0)) for h5_file in h5_files}
+    suggestion = None
+    previous = None
+    start = time.time()
+    print(f"{'sample':>10} {'%':>6} {'time/s':>7} {'threshold':>10} {'low':>7} {'high':>7} "
+          f"{'pump':>16} {'probe':>16}")
+    while True:
+        for h5_file, n in zip(h5_files, n_frames):
+            frames, values = samples[h5_file]
+            new = np.setdiff1d(stratified_frames(n, fraction, rng), frames)
+            if new.size:
+                frames = np.concatenate([frames, new])
+                values = np.concatenate([values, read_intensity(h5_file, new, index, dataset)])
+                order = np.argsort(frames)
+                samples[h5_file] = (frames[order], values[order])
+        n_sample = sum(frames.size for frames, values in samples.values())
+        line = f"{n_sample:10d} {100 * n_sample / max(sum(n_frames), 1):6.2f} {time.time() - start:7.1f} "
+        try:
+            suggestion = suggest_threshold(np.concatenate([values for frames, values in samples.values()]))
+        except ValueError as e:
+            suggestion = None
+            print(line + f"threshold not estimated: {e}")
+        if suggestion:
+            fractions, errors = stratified_fractions([samples[h5_file][1] for h5_file in h5_files], n_frames,
+                                                     suggestion["threshold_low"], suggestion["threshold_high"])
+            print(line + f"{suggestion['threshold']:10.2f} {suggestion['threshold_low']:7.2f} "
+                  f"{suggestion['threshold_high']:7.2f} {fractions[0]:8.3f} +-{errors[0]:.3f} "
+                  f"{fractions[1]:8.3f} +-{errors[1]:.3f}")
+            tolerance = stable * min(suggestion["sigmas"])
+            if (previous is not None and abs(suggestion["threshold"] - previous) < tolerance
+                    and max(errors[:2]) < error):
+                print(f"Threshold is stable - changed by less than {tolerance:.2f} ({stable:g} sigma) in the last "
+                      f"round, fractions are known within +-{error:g}")
+                break
+            previous = suggestion["threshold"]
+        if fraction >= max_fraction or n_sample >= sum(n_frames):
+            print("Threshold or fractions are not precise enough yet, the largest sample reached")
+            break
+        fraction = min(2 * fraction, max_fraction)
+    return samples, suggestion
+
+
+def write_preview(samples, outputplot="average_intensity_preview.png"):
+    """Histogram of the sampled frames - plot and counts"""
+    histogram = Histogram(100, 200)
+    for frames, values in samples.values():
+        histogram.add(values)
+    print(f"Counts of the histogram of sampled images saved in {histogram.write(counts_filename(outputplot))}")
+    if histogram.plot(outputplot):
+        print(f"Histogram of sampled images plotted to {outputplot}")
+    return histogram
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="pppp - X-ray Pump and Probe Processing Pipeline - preview of the histogram and threshold from a sample of frames"
+    )
+    parser.add_argument(
+        "--dir", "--path",
+        help="Absolute path to the directory with data",
+        type=str,
+        required=True,
+        dest="path"
+    )
+    parser.add_argument(
+        "--files",
+        help="Names of files to be involved in processing",
+        type=str,
+        required=True,
+        nargs="+"
+    )
+    parser.add_argument(
+        "--geom",
+        help="Absolute path to a geometry file for DIALS or xia2",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--dataset",
+        help=f"Dataset with the frames (default: {H5_DATASET})",
+        type=str,
+        default=H5_DATASET,
+    )
+    parser.add_argument(
+        "--fraction",
+        help=f"Fraction of frames sampled in the first round (default: {FRACTION})",
+        type=float,
+        default=FRACTION,
+    )
+    parser.add_argument(
+        "--max-fraction",
+        help=f"Largest fraction of frames sampled (default: {MAX_FRACTION})",
+        type=float,
+        default=MAX_FRACTION,
+        dest="max_fraction",
+    )
+    parser.add_argument(
+        "--stable",
+        help=f"Stop when the threshold changes less than this between rounds, in standard deviations of the narrower of pump and probe intensities (default: {STABLE})",
+        type=float,
+        default=STABLE,
+    )
+    parser.add_argument(
+        "--error",
+        help=f"Stop when fractions of pump and probe images are known within this, half-width of the 95 %% confidence interval (default: {ERROR})",
+        type=float,
+        default=ERROR,
+    )
+    parser.add_argument(
+        "--output", "-o",
+        help="Output plot (default: average_intensity_preview.png), counts are saved in a CSV file with the suffix _histogram",
+        type=str,
+        default="average_intensity_preview.png",
+    )
+    parser.add_argument(
+        "--roi",
+        help="Use only pixels in this region of the image (rows and columns as stored in the file)",
+        type=int,
+        nargs=4,
+        metavar=("slow_start", "slow_stop", "fast_start", "fast_stop"),
+    )
+    parser.add_argument(
+        "--stride",
+        help="Use only every N-th row of pixels, e.g. 10 for 10 %% of pixels (default: 1 - all)",
+        type=int,
+        default=1,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--mask",
+        help="Use only pixels True in a boolean array of the shape of an image saved in a .npy file",
+        type=str,
+    )
+    args = parser.parse_args()
+
+    try:
+        pixels = pixel_config(args.roi, args.stride, args.mask)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    if args.path[-1] == "/":
+        args.path = args.path[:-1]
+    files = expand_files(args.files)
+    h5_files = [h5_path(args.path, f) for f in files]
+    missing = [h5_file for h5_file in h5_files if not os.path.isfile(h5_file)]
+    for h5_file in missing:
+        print(f"WARNING: File not found: {h5_file}")
+    h5_files = [h5_file for h5_file in h5_files if h5_file not in missing]
+    if not h5_files:
+        sys.exit("No files to preview")
+    n_frames = [count_frames(h5_file, args.dataset) for h5_file in h5_files]
+    print(f"Preview of {sum(n_frames)} images in {len(h5_files)} files")
+    try:
+        samples, suggestion = preview(h5_files, n_frames, args.geom, args.dataset, args.fraction, args.max_fraction,
+                                      args.stable, pixels=pixels, error=args.error)
+    except ValueError as e:
+        sys.exit(str(e))
+    print("")
+    write_preview(samples, args.output)
+    if suggestion:
+        print_suggestion(suggestion)
+
+
+if __name__ == "__main__":
+    run()
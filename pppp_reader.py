@@ -0,0 +1,181 @@
+import collections
+import concurrent.futures
+import contextlib
+import os
+import zlib
+import numpy as np
+import h5py
+from pppp_events import H5_DATASET
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# chunk-aware reader of frames from HDF5 files
+#
+# Frames are read in blocks aligned to the HDF5 chunks of the dataset, so
+# no chunk is read (and decompressed) twice. If every chunk holds whole
+# frames and its filters are only gzip and shuffle (or none), the chunks
+# are read as stored (read_direct_chunk) and decompressed here by zlib,
+# which releases the GIL - blocks are read by a pool of threads, so more
+# chunks are decompressed at once while the frames already read are
+# reduced. Other datasets are read by h5py in the same threads.
+#
+# Only some rows of every frame can be read (e.g. the rows of a region of
+# interest or every n-th row). If the chunks are not compressed, only
+# these rows are read from the file (read_rows - by offsets of the chunks,
+# h5py is slow with strided selections). Compressed chunks of whole frames
+# are always decompressed in full.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+
+BLOCK_BYTES = 64 << 20  # frames read at once take about this many bytes
+READ_THREADS = min(4, os.cpu_count() or 1)
+GZIP = 1  # HDF5 filter ids
+SHUFFLE = 2
+
+
+def direct_filters(data):
+    """Filters of a dataset if its chunks can be read as stored and decoded
+    here - every chunk holds whole frames and there is no filter other than
+    gzip and shuffle. None otherwise."""
+    if data.chunks is None or data.ndim < 2 or tuple(data.chunks[1:]) != tuple(data.shape[1:]):
+        return None
+    plist = data.id.get_create_plist()
+    filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+    if any(f not in (GZIP, SHUFFLE) for f in filters):
+        return None
+    return filters
+
+
+def decode_chunk(raw, filter_mask, filters, dtype, shape):
+    """Chunk from its bytes as stored - filters are undone in the reverse
+    order, those marked in filter_mask were not applied to the chunk."""
+    for i in reversed(range(len(filters))):
+        if filter_mask & (1 << i):
+            continue
+        if filters[i] == GZIP:
+            raw = zlib.decompress(raw)
+        elif filters[i] == SHUFFLE:
+            # bytes of the same significance are stored together
+            planes = np.frombuffer(raw, dtype=np.uint8).reshape(dtype.itemsize, -1)
+            values = np.empty((planes.shape[1], dtype.itemsize), dtype=np.uint8)
+            for j in range(dtype.itemsize):
+                values[:, j] = planes[j]
+            raw = values
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def block_frames(data, rows=None, block_bytes=BLOCK_BYTES):
+    """Number of frames of a dataset (only rows (first, stop, step) of every
+    frame if given) taking about block_bytes bytes, at least one"""
+    n_rows = len(range(*rows)) if rows else data.shape[1]
+    frame_bytes = n_rows * int(np.prod(data.shape[2:], dtype=np.int64)) * data.dtype.itemsize
+    return max(1, block_bytes // max(1, frame_bytes))
+
+
+def frame_blocks(start, stop, block_size, chunk_frames=1):
+    """(start, stop) of blocks of at most block_size frames - rounded to
+    whole chunks - with bounds on chunk boundaries"""
+    block_size = max(chunk_frames, block_size // chunk_frames * chunk_frames)
+    blocks = []
+    while start < stop:
+        end = min((start // block_size + 1) * block_size, stop)
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+
+def read_block(data, start, stop, rows=None, filters=None):
+    """Frames start:stop of a dataset, only rows (first, stop, step) of every
+    frame if given. Chunks are read as stored if filters are given (from
+    direct_filters)."""
+    rows = slice(*rows) if rows else slice(None)
+    if filters is None:
+        return data[start:stop, rows]
+    chunk_frames = data.chunks[0]
+    chunk_shape = tuple(data.chunks)
+    zeros = (0,) * (data.ndim - 1)
+    frame_shape = (len(range(*rows.indices(data.shape[1]))),) + tuple(data.shape[2:])
+    out = np.empty((stop - start,) + frame_shape, dtype=data.dtype)
+    first = start // chunk_frames * chunk_frames
+    for chunk_start in range(first, stop, chunk_frames):
+        a, b = max(chunk_start, start), min(chunk_start + chunk_frames, stop)
+        try:
+            filter_mask, raw = data.id.read_direct_chunk((chunk_start,) + zeros)
+        except (OSError, RuntimeError):
+            # chunk not written - h5py gives the fill value
+            out[a - start:b - start] = data[a:b, rows]
+            continue
+        chunk = decode_chunk(raw, filter_mask, filters, data.dtype, chunk_shape)
+        out[a - start:b - start] = chunk[a - chunk_start:b - chunk_start, rows]
+    return out
+
+
+def read_rows(data, start, stop, rows, fd):
+    """Frames start:stop of a dataset with chunks of whole frames without
+    filters, only rows (first, stop, step) - read from the file (opened as
+    fd) by offsets of the chunks, other rows are not read at all."""
+    selected = range(*slice(*rows).indices(data.shape[1]))
+    row_bytes = int(np.prod(data.shape[2:], dtype=np.int64)) * data.dtype.itemsize
+    frame_bytes = data.shape[1] * row_bytes
+    # consecutive rows are read at once
+    n_rows = len(selected) if selected.step == 1 else 1
+    out = np.empty((stop - start, len(selected)) + tuple(data.shape[2:]), dtype=data.dtype)
+    buffer = memoryview(out.reshape(-1).view(np.uint8))
+    chunk_frames = data.chunks[0]
+    zeros = (0,) * (data.ndim - 1)
+    position = 0
+    for chunk_start in range(start // chunk_frames * chunk_frames, stop, chunk_frames):
+        a, b = max(chunk_start, start), min(chunk_start + chunk_frames, stop)
+        offset = data.id.get_chunk_info_by_coord((chunk_start,) + zeros).byte_offset
+        if offset is None:
+            # chunk not written - h5py gives the fill value
+            out[a - start:b - start] = data[a:b, slice(*rows)]
+            position += (b - a) * len(selected) * row_bytes
+            continue
+        for frame in range(a, b):
+            for row in selected[::n_rows]:
+                size = n_rows * row_bytes
+                if os.preadv(fd, [buffer[position:position + size]],
+                             offset + (frame - chunk_start) * frame_bytes + row * row_bytes) != size:
+                    raise OSError(f"Unexpected end of file {data.file.filename}")
+                position += size
+    return out
+
+
+def read_frames(filename, dataset=H5_DATASET, block_size=None, start=0, stop=None, threads=READ_THREADS, rows=None):
+    """Yield (first frame, frames) in blocks of about block_size frames
+    (default: BLOCK_BYTES of frames) of frames start:stop of a file, only
+    rows (first, stop, step) of every frame if given. Up to threads blocks are
+    read ahead in a pool of threads."""
+    with h5py.File(filename, "r") as f:
+        data = f[dataset]
+        if stop is None or stop > data.shape[0]:
+            stop = data.shape[0]
+        if not block_size:
+            block_size = block_frames(data, rows)
+        filters = direct_filters(data)
+        blocks = frame_blocks(start, stop, block_size, data.chunks[0] if data.chunks else 1)
+        with contextlib.ExitStack() as stack:
+            if rows and filters == [] and hasattr(data.id, "get_chunk_info_by_coord"):
+                fd = stack.enter_context(open(filename, "rb")).fileno()
+                def read(a, b):
+                    return read_rows(data, a, b, rows, fd)
+            else:
+                def read(a, b):
+                    return read_block(data, a, b, rows, filters)
+            if threads <= 1:
+                for a, b in blocks:
+                    yield a, read(a, b)
+                return
+            pool = stack.enter_context(concurrent.futures.ThreadPoolExecutor(threads))
+            pending = collections.deque()
+            for a, b in blocks:
+                pending.append((a, pool.submit(read, a, b)))
+                if len(pending) > threads:
+                    a, future = pending.popleft()
+                    yield a, future.result()
+            while pending:
+                a, future = pending.popleft()
+                yield a, future.result()
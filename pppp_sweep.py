@@ -0,0 +1,147 @@
+import argparse
+import os
+import sys
+import numpy as np
+from pppp_table import load_results
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# threshold sweep - how many images would be pump and probe
+#
+# Average intensities of every file are sorted once, numbers of images
+# below and above any threshold are then found by binary search. Only
+# the results of the 1st script are read, nothing is written, so
+# thresholds can be compared before pppp2.py creates any files or jobs.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# dials.python pppp_sweep.py --range 20 40 1
+# dials.python pppp_sweep.py --thresholds 28 30 32 --width 4 --files 133451 133452 --per-file
+# ----------------------------------------------------------------------
+
+
+def find_results(runs=None):
+    """Folders in the working directory with results of the 1st script,
+    optionally only those of the given runs. Hidden folders (.pppp_done)
+    and folders without results, e.g. of groups (pump, probe), are skipped."""
+    files = []
+    for entry in os.scandir("."):
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        if runs and not any(entry.name == r or entry.name.startswith(r + "-") for r in runs):
+            continue
+        if os.path.isfile(f"{entry.name}/average_intensity.npy") or os.path.isfile(f"{entry.name}/average_intensity.csv"):
+            files.append(entry.name)
+    return sorted(files)
+
+
+def sweep(sorted_values, thresholds_low, thresholds_high=None):
+    """Numbers of pump (below threshold_low), probe (threshold_high or
+    above) and not assigned images for every pair of thresholds, as an
+    array of shape (number of thresholds, 3)."""
+    thresholds_low = np.asarray(thresholds_low, dtype=np.float64)
+    thresholds_high = thresholds_low if thresholds_high is None else np.maximum(thresholds_high, thresholds_low)
+    n = sorted_values.size
+    pump = np.searchsorted(sorted_values, thresholds_low, side="left")
+    probe = n - np.searchsorted(sorted_values, thresholds_high, side="left")
+    return np.stack([pump, probe, n - pump - probe], axis=1)
+
+
+def sweep_files(files, thresholds_low, thresholds_high=None, feature="intensity"):
+    """Counts from sweep() for every file, {file: counts} - images are
+    split on the column feature of average_intensity.npy, images without
+    a value (NaN) are not assigned as by pppp2.py"""
+    counts = {}
+    for f in files:
+        values = np.asarray(load_results(f"{f}/average_intensity")[feature], dtype=np.float64)
+        finite = np.isfinite(values)
+        counts[f] = sweep(np.sort(values[finite]), thresholds_low, thresholds_high)
+        counts[f][:, 2] += values.size - np.count_nonzero(finite)
+    return counts
+
+
+def print_sweep(thresholds_low, thresholds_high, counts, label=None):
+    if label:
+        print(label)
+    print(f"{'threshold_low':>14} {'threshold_high':>14} {'pump':>10} {'probe':>10} {'not_assigned':>12} {'probe/pump':>10}")
+    for low, high, (pump, probe, not_assigned) in zip(thresholds_low, thresholds_high, counts):
+        ratio = f"{probe / pump:10.3f}" if pump else f"{'-':>10}"
+        print(f"{low:14.2f} {high:14.2f} {pump:10d} {probe:10d} {not_assigned:12d} {ratio}")
+    print("")
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="pppp - X-ray Pump and Probe Processing Pipeline - numbers of pump and probe images for a range of thresholds"
+    )
+    thresholds = parser.add_mutually_exclusive_group(required=True)
+    thresholds.add_argument(
+        "--range",
+        help="Thresholds from start to stop (included) with a step",
+        type=float,
+        nargs=3,
+        metavar=("start", "stop", "step"),
+    )
+    thresholds.add_argument(
+        "--thresholds",
+        help="List of thresholds",
+        type=float,
+        nargs="+",
+        metavar="threshold",
+    )
+    parser.add_argument(
+        "--width",
+        help="Distance between threshold_low and threshold_high - images between them are not assigned (default: 0)",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--files",
+        help="Names of runs or files to be involved (default: all folders with average_intensity.npy)",
+        type=str,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--feature",
+        help="Column of average_intensity.npy used instead of the average intensity, e.g. band_ratio (default: intensity)",
+        type=str,
+        default="intensity",
+    )
+    parser.add_argument(
+        "--per-file",
+        help="Report also numbers of images in individual files",
+        action="store_true",
+        dest="per_file",
+    )
+    args = parser.parse_args()
+
+    if args.range:
+        start, stop, step = args.range
+        if step <= 0:
+            sys.exit("Step of the range has to be positive")
+        thresholds_low = np.arange(start, stop + step / 2, step)
+    else:
+        thresholds_low = np.array(sorted(args.thresholds))
+    thresholds_high = thresholds_low + args.width
+    files = find_results(args.files)
+    if not files:
+        sys.exit("No results of the 1st script (average_intensity.npy) found in the working directory")
+
+    try:
+        counts = sweep_files(files, thresholds_low, thresholds_high, args.feature)
+    except ValueError:
+        sys.exit(f"Feature {args.feature} not found in average_intensity.npy of all files")
+    if args.per_file:
+        for f in files:
+            print_sweep(thresholds_low, thresholds_high, counts[f], label=f"File {f}")
+    total = sum(counts.values())
+    print_sweep(thresholds_low, thresholds_high, total, label=f"All {len(files)} files - {int(total[0].sum())} images")
+    i = np.argmin(np.abs(total[:, 0] - total[:, 1]))
+    print(f"Most balanced pump and probe: threshold_low {thresholds_low[i]:.2f} threshold_high {thresholds_high[i]:.2f} "
+          f"- pump {total[i, 0]} probe {total[i, 1]}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import numpy as np
+import h5py
+from pppp_api import expand_files
+from pppp_events import H5_DATASET, count_frames, h5_path, write_events_lst
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# synthetic cheetah data - HDF5 files, reference geometry and events.lst
+#
+# Every frame gets a level of intensity from one of two normal
+# distributions (pump - lower, probe - higher) and its pixels are this
+# level plus noise, so the average total scattered intensity of the
+# frame is close to the level. Files are written in the same layout as
+# cheetah: <dir>/<run>-<n>/run<run>-<n>.h5 with frames in /data/data.
+# The levels and true dose points are stored in /synthetic of every file.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# dials.python pppp_synthetic.py --dir /path/to/synthetic --files 900001 --frames 1000
+# dials.python pppp_synthetic.py --dir /path/to/synthetic --files 900001-0 900002-0 --frames 5000 --shape 256 256 \
+#     --pump-mean 20 --probe-mean 40 --sigma 3 --pump-fraction 0.4
+# dials.python pppp.py --dir /path/to/synthetic --files 900001 --geom /path/to/synthetic/reference.expt --local 4
+# ----------------------------------------------------------------------
+
+SHAPE = (64, 64)  # slow, fast of a frame
+WRITE_BYTES = 256 << 20  # frames generated and written at once take about this many bytes
+
+
+def synthetic_geometry(shape=SHAPE, n_panels=1, pixel_size=0.075, distance=100.0, wavelength=1.0):
+    """DIALS experiment list (.expt content) with panels of shape (slow, fast)
+    one after another along the slow axis, centred on the beam."""
+    n_slow, n_fast = shape
+    height = n_slow * n_panels * pixel_size
+    panels = []
+    for i in range(n_panels):
+        panels.append({
+            "name": f"panel{i}",
+            "fast_axis": [1.0, 0.0, 0.0],
+            "slow_axis": [0.0, -1.0, 0.0],
+            "origin": [-n_fast * pixel_size / 2, height / 2 - i * n_slow * pixel_size, -distance],
+            "pixel_size": [pixel_size, pixel_size],
+            "image_size": [n_fast, n_slow],
+            "trusted_range": [-1, 65535],
+        })
+    return {
+        "__id__": "ExperimentList",
+        "experiment": [{"__id__": "Experiment", "beam": 0, "detector": 0}],
+        "beam": [{"direction": [0.0, 0.0, 1.0], "wavelength": wavelength}],
+        "detector": [{"panels": panels}],
+    }
+
+
+def write_geometry(filename, shape=SHAPE, n_panels=1):
+    with open(filename, "w") as f:
+        json.dump(synthetic_geometry(shape, n_panels), f, indent=2)
+    return filename
+
+
+def frame_levels(n_frames, pump_mean=20.0, probe_mean=40.0, sigma=3.0, pump_fraction=0.5, rng=None):
+    """Level of intensity and true dose point (0 - pump, 1 - probe) of every frame"""
+    rng = np.random.default_rng() if rng is None else rng
+    dose_point = (rng.random(n_frames) >= pump_fraction).astype(np.int64)
+    means = np.where(dose_point == 0, pump_mean, probe_mean)
+    levels = np.maximum(rng.normal(means, sigma), 0)
+    return levels, dose_point
+
+
+def write_run(filename, levels, dose_point, shape=SHAPE, dataset=H5_DATASET, chunk_frames=1, rng=None):
+    """Cheetah-like HDF5 file with a frame for every level. Pixels have
+    noise with the variance equal to the level (as counting statistics).
+    Frames are generated in float32 and written as int32, together about
+    WRITE_BYTES at once."""
+    rng = np.random.default_rng() if rng is None else rng
+    n_frames = len(levels)
+    write_size = max(1, WRITE_BYTES // (8 * int(np.prod(shape))))
+    with h5py.File(filename, "w") as f:
+        data = f.create_dataset(dataset, shape=(n_frames,) + tuple(shape), dtype=np.int32,
+                                chunks=(min(chunk_frames, n_frames) or 1,) + tuple(shape))
+        for start in range(0, n_frames, write_size):
+            level = levels[start:start + write_size, None, None].astype(np.float32)
+            frames = rng.standard_normal((level.shape[0],) + tuple(shape), dtype=np.float32)
+            frames *= np.sqrt(level)
+            frames += level
+            np.rint(frames, out=frames)
+            np.maximum(frames, 0, out=frames)
+            data[start:start + level.shape[0]] = frames.astype(np.int32)
+        f.create_dataset("synthetic/level", data=levels)
+        f.create_dataset("synthetic/dose_point", data=dose_point)
+    return filename
+
+
+def generate(path, files, n_frames, shape=SHAPE, n_panels=1, pump_mean=20.0, probe_mean=40.0, sigma=3.0,
+             pump_fraction=0.5, dataset=H5_DATASET, chunk_frames=1, seed=None):
+    """Files <path>/<file>/run<file>.h5 with n_frames frames each (a number
+    or a list for every file), reference.expt and events.lst in path.
+    Returns paths of the HDF5 files."""
+    rng = np.random.default_rng(seed)
+    if np.isscalar(n_frames):
+        n_frames = [n_frames] * len(files)
+    os.makedirs(path, exist_ok=True)
+    write_geometry(os.path.join(path, "reference.expt"), shape, n_panels)
+    frame_shape = (shape[0] * n_panels, shape[1])
+    h5_files = []
+    for f, n in zip(files, n_frames):
+        os.makedirs(os.path.join(path, f), exist_ok=True)
+        levels, dose_point = frame_levels(n, pump_mean, probe_mean, sigma, pump_fraction, rng)
+        h5_files.append(write_run(h5_path(path, f), levels, dose_point, frame_shape, dataset, chunk_frames, rng))
+    write_events_lst(os.path.join(path, "events.lst"), h5_files, list(n_frames))
+    return h5_files
+
+
+def read_truth(h5_file):
+    """Levels and true dose points of a synthetic file"""
+    with h5py.File(h5_file, "r") as f:
+        return f["synthetic/level"][()], f["synthetic/dose_point"][()]
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="pppp - X-ray Pump and Probe Processing Pipeline - synthetic cheetah HDF5 files for testing"
+    )
+    parser.add_argument(
+        "--dir", "--path",
+        help="Directory for the data - created if it does not exist",
+        type=str,
+        required=True,
+        dest="path"
+    )
+    parser.add_argument(
+        "--files",
+        help="Names of files, e.g. 900001-0, or runs which are expanded to files -0 -1 -2",
+        type=str,
+        required=True,
+        nargs="+"
+    )
+    parser.add_argument(
+        "--frames",
+        help="Number of frames in every file (default: 1000)",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--shape",
+        help=f"Size of a panel in pixels (default: {SHAPE[0]} {SHAPE[1]})",
+        type=int,
+        nargs=2,
+        default=SHAPE,
+        metavar=("slow", "fast"),
+    )
+    parser.add_argument(
+        "--panels",
+        help="Number of panels of the detector (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--pump-mean",
+        help="Mean intensity of pump frames (default: 20)",
+        type=float,
+        default=20.0,
+        dest="pump_mean",
+    )
+    parser.add_argument(
+        "--probe-mean",
+        help="Mean intensity of probe frames (default: 40)",
+        type=float,
+        default=40.0,
+        dest="probe_mean",
+    )
+    parser.add_argument(
+        "--sigma",
+        help="Standard deviation of the intensity of frames in both groups (default: 3)",
+        type=float,
+        default=3.0,
+    )
+    parser.add_argument(
+        "--pump-fraction",
+        help="Fraction of pump frames (default: 0.5)",
+        type=float,
+        default=0.5,
+        dest="pump_fraction",
+    )
+    parser.add_argument(
+        "--dataset",
+        help=f"Dataset with the frames (default: {H5_DATASET})",
+        type=str,
+        default=H5_DATASET,
+    )
+    parser.add_argument(
+        "--chunk-frames",
+        help="Number of frames in an HDF5 chunk - cheetah writes one (default: 1)",
+        type=int,
+        default=1,
+        dest="chunk_frames",
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed of the random generator",
+        type=int,
+    )
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.path)
+    files = expand_files(args.files)
+    h5_files = generate(path, files, args.frames, tuple(args.shape), args.panels, args.pump_mean, args.probe_mean,
+                        args.sigma, args.pump_fraction, args.dataset, args.chunk_frames, args.seed)
+    for h5_file in h5_files:
+        print(f"File created: {h5_file} ({count_frames(h5_file, args.dataset)} frames)")
+    print(f"File created: {os.path.join(path, 'reference.expt')}")
+    print(f"File created: {os.path.join(path, 'events.lst')}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,334 @@
+import os
+import struct
+import numpy as np
+from pppp_events import tag_event
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# per-frame results stored as a typed binary table
+#
+# Results travel between the scripts as a NumPy structured array saved
+# in .npy (average_intensity.npy, average_intensity_all.npy) which is
+# memory-mapped when read - no parsing. CSV files with the same content
+# are exported only for humans, but can still be read if no .npy exists.
+# Features of frames other than the average intensity (pppp_intensity.py
+# --bands --bright --profile-bins) are stored as additional columns.
+#
+# Tables of runs are merged in chunks: a k-way merge ordered by (run,
+# event) yields records as soon as no table can contain an earlier one,
+# and TableWriter appends them to the .npy file and fills in the number
+# of records when it is closed. Only a chunk of every table is in memory,
+# however many frames there are. As every file has a table of its own run,
+# RunMerger can also append the tables in the order of run while they are
+# still being calculated - each as soon as all the earlier runs are written.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+
+DTYPE = np.dtype([
+    ("run", "S32"),  # file name, e.g. 133451-0
+    ("event", np.int64),  # frame in the file
+    ("intensity", np.float64),  # average total scattered intensity
+    ("group", np.int32),  # dose point: 0 - pump, 1 - probe, 2 - not assigned, bin of dose_point_split, -1 - not split yet
+])
+NOT_SPLIT = -1
+MERGE_CHUNK = 1 << 16  # records of every table in memory while merging
+
+
+def table_dtype(features=None):
+    """DTYPE with additional columns of features (a structured dtype, e.g.
+    from pppp_intensity.feature_dtype)"""
+    if features is None or features.names is None:
+        return DTYPE
+    return np.dtype(DTYPE.descr + [field for field in features.descr if field[0] not in DTYPE.names])
+
+
+def make_table(run, events, intensity, group=None):
+    """Table of frames of a run - intensity is an array of average
+    intensities or of features with a column intensity."""
+    intensity = np.asarray(intensity)
+    table = np.zeros(len(events), dtype=table_dtype(intensity.dtype))
+    table["run"] = run
+    table["event"] = events
+    if intensity.dtype.names:
+        for name in intensity.dtype.names:
+            table[name] = intensity[name]
+    else:
+        table["intensity"] = intensity
+    table["group"] = NOT_SPLIT if group is None else group
+    return table
+
+
+def common_dtype(tables):
+    """Columns present in all tables, those of DTYPE as in DTYPE (tables of
+    older versions have a narrower column group)"""
+    names = [name for name in tables[0].dtype.names if all(name in t.dtype.names for t in tables)]
+    return np.dtype([(name, (DTYPE if name in DTYPE.names else tables[0].dtype).fields[name][0]) for name in names])
+
+
+def concatenate_tables(tables):
+    """Tables joined to one, only columns present in all of them are kept"""
+    dtype = common_dtype(tables)
+    return np.concatenate([np.asarray(t[list(dtype.names)]).astype(dtype) for t in tables])
+
+
+def _before(table, run, event):
+    """Records of a table at or before (run, event)"""
+    return (table["run"] < run) | ((table["run"] == run) & (table["event"] <= event))
+
+
+def _chunks(table, dtype, chunk_size):
+    """Chunks of a table with columns of dtype, checked to be sorted"""
+    last = np.zeros(0, dtype=dtype)
+    for start in range(0, len(table), chunk_size):
+        chunk = np.asarray(table[start:start + chunk_size][list(dtype.names)]).astype(dtype)
+        records = np.concatenate([last, chunk])
+        if not np.all(_before(records[:-1], records["run"][1:], records["event"][1:])):
+            raise ValueError("Table is not sorted by run and event")
+        last = chunk[-1:]
+        yield chunk
+
+
+def merge_tables(tables, chunk_size=MERGE_CHUNK):
+    """Chunks of records of tables (each sorted by run and event, as
+    written for every file) in the order of (run, event). A chunk is
+    yielded as soon as no table can have an earlier record, only
+    chunk_size records of every table are in memory. Only columns present
+    in all tables are kept."""
+    if not tables:
+        return
+    dtype = common_dtype(tables)
+    sources = [_chunks(table, dtype, chunk_size) for table in tables]
+    buffers = {i: next(source) for i, source in enumerate(sources) if len(tables[i])}
+    while buffers:
+        # every table is sorted, so nothing after the smallest last record
+        # of the buffers can come before it
+        run, event = min((b["run"][-1], b["event"][-1]) for b in buffers.values())
+        parts = []
+        for i in list(buffers):
+            b = buffers[i]
+            n = int(np.count_nonzero(_before(b, run, event)))
+            parts.append(b[:n])
+            if n < len(b):
+                buffers[i] = b[n:]
+            else:
+                b = next(sources[i], None)
+                if b is None:
+                    del buffers[i]
+                else:
+                    buffers[i] = b
+        chunk = np.concatenate(parts)
+        yield chunk[np.lexsort((chunk["event"], chunk["run"]))]
+
+
+class RunMerger:
+    """Tables of runs written by writer (a TableWriter) in the order of
+    (run, event), while they are added in any order - a table is written
+    as soon as the tables of all earlier runs are. Every table holds only
+    records of its run, sorted by event."""
+    def __init__(self, writer, runs):
+        self.writer = writer
+        self.order = sorted(runs, key=lambda run: run.encode())  # as column run compares
+        self.waiting = {}
+        self.n_written = 0
+
+    def add(self, run, table):
+        """Add the table of a run, returns the number of runs done"""
+        self.waiting[run] = table
+        while self.n_written < len(self.order) and self.order[self.n_written] in self.waiting:
+            run = self.order[self.n_written]
+            for chunk in merge_tables([self.waiting.pop(run)]):
+                if np.any(chunk["run"] != run.encode()):
+                    raise ValueError(f"Table of run {run} has records of other runs")
+                self.writer.write(chunk)
+            self.n_written += 1
+        return self.n_written
+
+    def skip(self, run):
+        """Leave out a run without results, returns the number of runs done"""
+        return self.add(run, np.zeros(0, dtype=DTYPE))
+
+    def missing(self):
+        """Runs not added yet"""
+        return [run for run in self.order[self.n_written:] if run not in self.waiting]
+
+
+def table_tags(table):
+    """Image tags, e.g. run133451-0_000012"""
+    return [f"run{run.decode()}_{event:06d}" for run, event in zip(table["run"], table["event"])]
+
+
+def write_table(filename, table):
+    """Save the table - written to a temporary file first, so a reader
+    never sees a partially written table."""
+    table = np.asarray(table)
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, table.astype(table_dtype(table.dtype), copy=False))
+    os.replace(tmp, filename)
+    return filename
+
+
+def _npy_header(dtype, n, size=0):
+    """Header of a .npy file (format 1.0) of n records, padded to size
+    bytes or to a multiple of 64 as numpy does"""
+    text = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (n,)})
+    size = max(size, -(-(len(text) + 11) // 64) * 64)
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", size - 10) + (text.ljust(size - 11) + "\n").encode("latin1")
+
+
+class TableWriter:
+    """Table saved in chunks - the number of records is written to the
+    header when closed, so the whole table is never in memory. Written to
+    a temporary file first, as write_table."""
+    def __init__(self, filename, dtype=None):
+        self.filename = str(filename)
+        self.tmp = f"{self.filename}.{os.getpid()}.tmp"
+        self.dtype = None
+        self.n = 0
+        self.f = open(self.tmp, "wb")
+        if dtype is not None:
+            self._start(dtype)
+
+    def _start(self, dtype):
+        self.dtype = table_dtype(dtype)
+        # room for the largest possible number of records
+        self.header_size = len(_npy_header(self.dtype, np.iinfo(np.int64).max))
+        self.f.write(b"\0" * self.header_size)
+
+    def write(self, table):
+        table = np.asarray(table)
+        if self.dtype is None:
+            self._start(table.dtype)
+        self.f.write(table.astype(self.dtype, copy=False).tobytes())
+        self.n += len(table)
+
+    def close(self):
+        if self.dtype is None:
+            self._start(DTYPE)
+        self.f.seek(0)
+        self.f.write(_npy_header(self.dtype, self.n, self.header_size))
+        self.f.close()
+        os.replace(self.tmp, self.filename)
+        return self.filename
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.tmp)
+
+
+class ResultsWriter(TableWriter):
+    """stem.npy and stem.csv saved in chunks, as write_results"""
+    def __init__(self, stem, dtype=None):
+        super().__init__(stem + ".npy", dtype)
+        self.csv = open(stem + ".csv", "w")
+
+    def write(self, table):
+        super().write(table)
+        self.csv.write(csv_lines(table))
+
+    def close(self):
+        self.csv.close()
+        return super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.csv.close()
+        super().__exit__(exc_type, exc, tb)
+
+
+def read_table(filename, mmap=True):
+    return np.load(filename, mmap_mode="r" if mmap else None)
+
+
+def read_average_intensity_csv(filename="average_intensity.csv"):
+    """Image tags and average intensities from a CSV file as two arrays.
+    Records are separated by any whitespace, so blank lines or a file
+    without newlines are read as well."""
+    with open(filename, "r") as f:
+        records = f.read().split()
+    tags = np.array([r.split(",")[0] for r in records], dtype=str)
+    values = np.array([r.split(",")[1] for r in records], dtype=np.float64)
+    return tags, values
+
+
+def table_from_csv(filename):
+    tags, values = read_average_intensity_csv(filename)
+    stems_events = [tag_event(tag) for tag in tags]
+    table = np.zeros(len(tags), dtype=DTYPE)
+    table["run"] = [stem[3:] if stem.startswith("run") else stem for stem, event in stems_events]
+    table["event"] = [event for stem, event in stems_events]
+    table["intensity"] = values
+    table["group"] = NOT_SPLIT
+    return table
+
+
+def csv_lines(table):
+    return "".join(f"{tag},{value:.4f}\n" for tag, value in zip(table_tags(table), table["intensity"]))
+
+
+def export_csv(filename, table, chunk_size=MERGE_CHUNK):
+    """CSV file for humans: tag,average intensity"""
+    with open(filename, "w") as f:
+        for start in range(0, len(table), chunk_size):
+            f.write(csv_lines(table[start:start + chunk_size]))
+
+
+def write_results(stem, table):
+    """Save per-frame results as stem.npy and export stem.csv"""
+    write_table(stem + ".npy", table)
+    export_csv(stem + ".csv", table)
+
+
+def append_table(filename, table):
+    """Append records to the table in filename in place - only the new
+    records and the header with their number are written. Returns False
+    and writes nothing if the file has other columns or no room in the
+    header for the new number of records."""
+    table = np.asarray(table)
+    with open(filename, "r+b") as f:
+        if np.lib.format.read_magic(f) != (1, 0):
+            return False
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        header_size = f.tell()
+        if fortran_order or len(shape) != 1 or dtype != table_dtype(table.dtype):
+            return False
+        header = _npy_header(dtype, shape[0] + len(table), header_size)
+        if len(header) != header_size:
+            return False
+        # records first, so a reader sees the old number until they are written
+        f.seek(header_size + shape[0] * dtype.itemsize)
+        f.write(table.astype(dtype, copy=False).tobytes())
+        f.truncate()
+        f.seek(0)
+        f.write(header)
+    return True
+
+
+def append_results(stem, table):
+    """Append per-frame results to stem.npy and stem.csv, saved as
+    write_results if they do not exist. If they cannot be appended in
+    place (other columns, an older CSV only), they are written again with
+    the columns common to both."""
+    if os.path.isfile(stem + ".npy") and append_table(stem + ".npy", table):
+        with open(stem + ".csv", "a") as f:
+            f.write(csv_lines(table))
+        return stem
+    if os.path.isfile(stem + ".npy") or os.path.isfile(stem + ".csv"):
+        table = concatenate_tables([load_results(stem), table])
+    write_results(stem, table)
+    return stem
+
+
+def load_results(stem):
+    """Per-frame results from stem.npy (memory-mapped), or from stem.csv
+    if they were created by an older version."""
+    if os.path.isfile(stem + ".npy"):
+        return read_table(stem + ".npy")
+    return table_from_csv(stem + ".csv")
@@ -0,0 +1,155 @@
+import argparse
+import sys
+import numpy as np
+from pppp_table import read_table, table_from_csv
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# suggest a threshold dividing pump and probe images
+#
+# The distribution of average intensities is bimodal. It is binned and
+# a two-component Gaussian mixture is fitted to the histogram by EM,
+# starting from the Otsu threshold. The suggested threshold is where
+# both components are equally probable, threshold_low and threshold_high
+# are where an image belongs to the pump or probe component with the
+# requested confidence.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# dials.python pppp_threshold.py average_intensity_all.npy
+# ----------------------------------------------------------------------
+
+N_BINS = 1000
+CONFIDENCE = 0.95
+
+
+def otsu_threshold(counts, edges):
+    """Threshold maximising the between-class variance of a histogram."""
+    centers = (edges[:-1] + edges[1:]) / 2
+    w0 = np.cumsum(counts)
+    w1 = w0[-1] - w0
+    m0 = np.cumsum(counts * centers)
+    m1 = m0[-1] - m0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = w0 * w1 * (m0 / w0 - m1 / w1) ** 2
+    variance[~np.isfinite(variance)] = -1
+    return edges[np.argmax(variance) + 1]
+
+
+def _normal_pdf(x, mean, sigma):
+    return np.exp(-0.5 * ((x - mean) / sigma) ** 2) / (sigma * np.sqrt(2 * np.pi))
+
+
+def fit_gaussian_mixture(counts, edges, n_iter=500, tol=1e-10):
+    """Two-component Gaussian mixture fitted to a histogram by EM.
+    Returns weights, means and sigmas, the first component has the lower mean."""
+    x = (edges[:-1] + edges[1:]) / 2
+    w = counts.astype(np.float64)
+    n = w.sum()
+    bin_var = (edges[1] - edges[0]) ** 2 / 12
+    t = otsu_threshold(counts, edges)
+    low = x < t
+    weights = np.array([w[low].sum(), w[~low].sum()]) / n
+    if weights.min() == 0:
+        raise ValueError("Distribution of average intensities is not bimodal")
+    means = np.array([np.average(x[low], weights=w[low]), np.average(x[~low], weights=w[~low])])
+    sigmas = np.sqrt(np.array([np.average((x[low] - means[0]) ** 2, weights=w[low]),
+                               np.average((x[~low] - means[1]) ** 2, weights=w[~low])]) + bin_var)
+    log_likelihood = -np.inf
+    for i in range(n_iter):
+        pdf = weights[:, None] * _normal_pdf(x[None, :], means[:, None], sigmas[:, None])
+        total = pdf.sum(axis=0)
+        resp = pdf / np.where(total > 0, total, 1)
+        nk = (resp * w).sum(axis=1)
+        if nk.min() <= 0:
+            raise ValueError("Distribution of average intensities is not bimodal")
+        weights = nk / n
+        means = (resp * w * x).sum(axis=1) / nk
+        sigmas = np.sqrt((resp * w * (x - means[:, None]) ** 2).sum(axis=1) / nk + bin_var)
+        new_log_likelihood = (w * np.log(np.where(total > 0, total, 1e-300))).sum()
+        if abs(new_log_likelihood - log_likelihood) < tol * abs(new_log_likelihood):
+            break
+        log_likelihood = new_log_likelihood
+    order = np.argsort(means)
+    return weights[order], means[order], sigmas[order]
+
+
+def probe_probability(x, weights, means, sigmas):
+    """Posterior probability that an image with average intensity x belongs
+    to the upper component - calculated from log densities, so it is
+    defined also far from both means."""
+    z = (np.atleast_1d(x)[None, :] - means[:, None]) / sigmas[:, None]
+    log_pdf = np.log(weights)[:, None] - np.log(sigmas)[:, None] - 0.5 * z ** 2
+    return 1 / (1 + np.exp(np.clip(log_pdf[0] - log_pdf[1], -700, 700)))
+
+
+def suggest_threshold(values, confidence=CONFIDENCE, n_bins=N_BINS):
+    """Suggested threshold and threshold_low/threshold_high pair, see the header."""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if values.size < 10:
+        raise ValueError(f"Too few images to estimate the threshold: {values.size}")
+    counts, edges = np.histogram(values, bins=n_bins)
+    otsu = otsu_threshold(counts, edges)
+    weights, means, sigmas = fit_gaussian_mixture(counts, edges)
+    x = np.linspace(means[0], means[1], 10001)
+    p = probe_probability(x, weights, means, sigmas)
+    # p is increasing between the means
+    threshold = x[min(np.searchsorted(p, 0.5), x.size - 1)]
+    threshold_low = x[min(np.searchsorted(p, 1 - confidence), x.size - 1)]
+    threshold_high = x[min(np.searchsorted(p, confidence), x.size - 1)]
+    return {
+        "threshold": float(threshold),
+        "threshold_low": float(threshold_low),
+        "threshold_high": float(threshold_high),
+        "confidence": confidence,
+        "otsu": float(otsu),
+        "weights": weights.tolist(),
+        "means": means.tolist(),
+        "sigmas": sigmas.tolist(),
+        "n_images": int(values.size),
+    }
+
+
+def print_suggestion(suggestion):
+    print(f"Suggested threshold: {suggestion['threshold']:.2f} (Otsu: {suggestion['otsu']:.2f})")
+    print(f"Suggested threshold_low threshold_high at {100 * suggestion['confidence']:.0f} % confidence: "
+          f"{suggestion['threshold_low']:.2f} {suggestion['threshold_high']:.2f}")
+    print(f"Pump component:  mean {suggestion['means'][0]:.2f}  sigma {suggestion['sigmas'][0]:.2f}  fraction {suggestion['weights'][0]:.3f}")
+    print(f"Probe component: mean {suggestion['means'][1]:.2f}  sigma {suggestion['sigmas'][1]:.2f}  fraction {suggestion['weights'][1]:.3f}")
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="pppp - X-ray Pump and Probe Processing Pipeline - suggest a threshold dividing pump and probe images"
+    )
+    parser.add_argument(
+        "inputfile",
+        help="Table (.npy) or CSV file with average intensities (default: average_intensity_all.npy)",
+        type=str,
+        nargs="?",
+        default="average_intensity_all.npy",
+    )
+    parser.add_argument(
+        "--confidence",
+        help=f"Probability of correct assignment of images outside threshold_low - threshold_high (default: {CONFIDENCE})",
+        type=float,
+        default=CONFIDENCE,
+    )
+    args = parser.parse_args()
+
+    if args.inputfile.endswith(".npy"):
+        values = read_table(args.inputfile)["intensity"]
+    else:
+        values = table_from_csv(args.inputfile)["intensity"]
+    try:
+        suggestion = suggest_threshold(values, args.confidence)
+    except ValueError as e:
+        sys.exit(str(e))
+    print_suggestion(suggestion)
+
+
+if __name__ == "__main__":
+    run()
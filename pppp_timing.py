@@ -0,0 +1,155 @@
+import contextlib
+import json
+import os
+import time
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# timing of stages and jobs - JSON report and Chrome trace
+#
+# Stages of the scripts (splitting, writing files, ...) are timed in the
+# process. For every job the time of submission and the time when its
+# end was noticed are recorded, tasks of array jobs also write their
+# start and end to the sentinel file - so the time in the queue, the
+# run time and the delay of detection are known.
+#
+# The trace can be opened in chrome://tracing or https://ui.perfetto.dev
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+
+
+def read_sentinel(sentinel):
+    """Exit code, start and end of a task from its sentinel file - start
+    and end are None for sentinels without them."""
+    try:
+        with open(sentinel, "r") as f:
+            fields = f.read().split()
+    except OSError:
+        return None, None, None
+    values = []
+    for field in fields[:3]:
+        try:
+            values.append(float(field))
+        except ValueError:
+            values.append(None)
+    values += [None] * (3 - len(values))
+    exit_code = int(values[0]) if values[0] is not None else None
+    return exit_code, values[1], values[2]
+
+
+class Timeline:
+    """Timestamps (seconds since the epoch) of stages and jobs of a run"""
+    def __init__(self, name):
+        self.name = name  # e.g. pppp.py
+        self.start = time.time()
+        self.stages = []
+        self.jobs = {}  # job id: {"name", "submitted", "n_tasks"}
+        self.tasks = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages.append({"name": name, "start": start, "end": time.time()})
+
+    def submitted(self, job_ids, n_tasks=None, at=None):
+        """Jobs submitted at time at (default: now): {name: job id},
+        n_tasks - {name: number of tasks}"""
+        at = time.time() if at is None else at
+        for name, job_id in job_ids.items():
+            self.jobs[job_id] = {"name": name, "submitted": at, "n_tasks": (n_tasks or {}).get(name)}
+
+    def finished(self, job_id, task=None, sentinel=None):
+        """End of a job or task noticed now"""
+        exit_code, started, ended = read_sentinel(sentinel) if sentinel else (None, None, None)
+        job = self.jobs.get(job_id, {"name": str(job_id), "submitted": None})
+        self.tasks.append({
+            "name": job["name"], "job_id": job_id, "task": task, "exit_code": exit_code,
+            "submitted": job["submitted"], "started": started, "ended": ended, "detected": time.time(),
+        })
+
+    def report(self):
+        end = time.time()
+        tasks = []
+        for t in self.tasks:
+            t = dict(t)
+            if t["submitted"] is not None and t["started"] is not None:
+                t["queue_wait"] = t["started"] - t["submitted"]
+            if t["started"] is not None and t["ended"] is not None:
+                t["run"] = t["ended"] - t["started"]
+            if t["ended"] is not None:
+                t["detection_delay"] = t["detected"] - t["ended"]
+            tasks.append(t)
+        return {
+            "script": self.name,
+            "start": self.start,
+            "end": end,
+            "duration": end - self.start,
+            "stages": [dict(s, duration=s["end"] - s["start"]) for s in self.stages],
+            "jobs": [dict(j, job_id=job_id) for job_id, j in self.jobs.items()],
+            "tasks": tasks,
+        }
+
+    def chrome_trace(self):
+        """Trace events: stages of the script as process 1, every job as a
+        process with a thread per task - queue, run and detection delay."""
+        def us(t):
+            return (t - self.start) * 1e6
+
+        def span(name, cat, start, end, pid, tid, args=None):
+            return {"name": name, "cat": cat, "ph": "X", "ts": us(start), "dur": max(0, us(end) - us(start)),
+                    "pid": pid, "tid": tid, "args": args or {}}
+
+        events = [{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": self.name}}]
+        events += [span(s["name"], "stage", s["start"], s["end"], 1, 1) for s in self.stages]
+        pids = {}
+        for job_id, job in self.jobs.items():
+            pids[job_id] = len(pids) + 2
+            events.append({"name": "process_name", "ph": "M", "pid": pids[job_id],
+                           "args": {"name": f"{job['name']} ({job_id})"}})
+        for t in self.tasks:
+            pid = pids.get(t["job_id"], 0)
+            tid = t["task"] or 0
+            args = {"exit_code": t["exit_code"]}
+            if t["submitted"] is not None and t["started"] is not None:
+                events.append(span("queue", "job", t["submitted"], t["started"], pid, tid, args))
+            elif t["submitted"] is not None:
+                events.append(span("queue and run", "job", t["submitted"], t["detected"], pid, tid, args))
+            if t["started"] is not None and t["ended"] is not None:
+                events.append(span("run", "job", t["started"], t["ended"], pid, tid, args))
+                events.append(span("detection", "job", t["ended"], t["detected"], pid, tid, args))
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, directory="."):
+        """<script>_timing.json and <script>_trace.json in directory"""
+        stem = os.path.normpath(os.path.join(directory, os.path.splitext(self.name)[0]))
+        with open(f"{stem}_timing.json", "w") as f:
+            json.dump(self.report(), f, indent=2)
+        with open(f"{stem}_trace.json", "w") as f:
+            json.dump(self.chrome_trace(), f)
+        return f"{stem}_timing.json", f"{stem}_trace.json"
+
+    def print_summary(self):
+        for s in self.stages:
+            print(f"  {s['name']:<40} {s['end'] - s['start']:10.2f} s")
+        report = self.report()
+        for name in dict.fromkeys(t["name"] for t in report["tasks"]):
+            tasks = [t for t in report["tasks"] if t["name"] == name]
+            line = f"  job {name:<36} {len(tasks)} task(s)"
+            for key in ("queue_wait", "run", "detection_delay"):
+                values = [t[key] for t in tasks if key in t]
+                if values:
+                    line += f"  {key} max {max(values):.1f} s"
+            print(line)
+
+
+def write_timing(timeline, directory="."):
+    """Save the timings and print a summary"""
+    report, trace = timeline.write(directory)
+    print("")
+    print(f"Timings saved in {report} and {trace}")
+    timeline.print_summary()
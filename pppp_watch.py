@@ -0,0 +1,231 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import h5py
+from pppp_events import H5_DATASET, h5_path
+from pppp_intensity import build_radial_index, feature_config, load_reference_geometry, average_intensity_h5
+from pppp_api import classify
+from pppp_histogram import Histogram
+from pppp_table import append_results, load_results, make_table
+from pppp_threshold import print_suggestion, suggest_threshold
+
+# ----------------------------------------------------------------------
+# pppp - X-ray Pump and Probe Processing Pipeline
+# live mode - follow the cheetah directory during data collection
+#
+# New files run<f>-<n>.h5 and new frames appended to growing files are
+# picked up every period, their average intensity is calculated and
+# appended to <f>/average_intensity.npy (and .csv) - the files are not
+# written again, only the new records. A histogram of all images and
+# numbers of pump and probe images are kept up to date. Without --threshold,
+# a threshold is suggested from all images so far (as in pppp.py) whenever
+# new images come, so it is known while still on the beam. Features of frames
+# (--bands --bright --profile-bins, as in pppp.py) are added as columns;
+# results of an earlier run with other columns keep only the common ones.
+#
+# Martin Maly - martin.maly@soton.ac.uk
+# https://github.com/MartinMalyMM/pppp
+# ----------------------------------------------------------------------
+# EXAMPLE USAGE
+# dials.python pppp_watch.py --dir /path/to/cheetah/ --geom /path/to/refined.expt --threshold 30
+# dials.python pppp_watch.py --dir /path/to/cheetah/ --geom /path/to/refined.expt --files 133451 133452
+# ----------------------------------------------------------------------
+
+HISTOGRAM_MAX = 100  # the same range as the histogram from pppp.py
+HISTOGRAM_BINS = 200
+
+
+class LiveHistogram(Histogram):
+    """Histogram updated with new values, also counts pump and probe images
+    and keeps the values for suggestion of a threshold."""
+    def __init__(self, maximum=HISTOGRAM_MAX, n_bins=HISTOGRAM_BINS):
+        super().__init__(maximum, n_bins)
+        self.dose_point_counts = np.zeros(3, dtype=np.int64)  # pump, probe, not assigned
+        self.values = []  # arrays of finite values added
+
+    def add(self, values, threshold_low=None, threshold_high=None):
+        values = values[np.isfinite(values)]
+        super().add(values)
+        self.values.append(values)
+        if threshold_low is not None:
+            self.dose_point_counts += np.bincount(classify(values, threshold_low, threshold_high), minlength=3)
+        return self
+
+
+def find_files(path, runs=None):
+    """Names of files present in the cheetah directory, e.g. 133451-0,
+    optionally only those of the given runs."""
+    files = []
+    for entry in os.scandir(path):
+        if not entry.is_dir():
+            continue
+        if runs and not any(entry.name == r or entry.name.startswith(r + "-") for r in runs):
+            continue
+        if os.path.isfile(h5_path(path, entry.name)):
+            files.append(entry.name)
+    return sorted(files)
+
+
+def count_frames_live(filename, dataset=H5_DATASET):
+    """Number of frames in a file which may still be written, None if it
+    cannot be opened now."""
+    try:
+        try:
+            f = h5py.File(filename, "r", swmr=True)
+        except (OSError, ValueError):
+            f = h5py.File(filename, "r")
+        with f:
+            if dataset not in f:
+                return None
+            return f[dataset].shape[0]
+    except OSError:
+        return None
+
+
+def watch(path, geom, runs=None, threshold_low=None, threshold_high=None, period=30, dataset=H5_DATASET, once=False,
+          features=None):
+    index = build_radial_index(load_reference_geometry(geom))
+    histogram = LiveHistogram()
+    done = {}  # file: number of frames already processed
+    while True:
+        n_new = 0
+        for f in find_files(path, runs):
+            h5_file = h5_path(path, f)
+            n = count_frames_live(h5_file, dataset)
+            if f not in done:
+                os.makedirs(f, exist_ok=True)
+                done[f] = 0
+                if os.path.isfile(f"{f}/average_intensity.npy") or os.path.isfile(f"{f}/average_intensity.csv"):
+                    # resume - include results from the previous run in the histogram
+                    table = load_results(f"{f}/average_intensity")
+                    histogram.add(np.asarray(table["intensity"]), threshold_low, threshold_high)
+                    done[f] = table.size
+            if n is None or n <= done[f]:
+                continue
+            try:
+                values = average_intensity_h5(h5_file, index, dataset, start=done[f], stop=n, features=features)
+            except OSError as e:
+                print(f"WARNING: {h5_file} cannot be read now: {e}")
+                continue
+            new = make_table(f, np.arange(done[f], done[f] + values.size), values)
+            append_results(f"{f}/average_intensity", new)
+            histogram.add(new["intensity"], threshold_low, threshold_high)
+            done[f] += values.size
+            n_new += values.size
+        histogram.write("average_intensity_live_histogram.csv")
+        n_total = histogram.n_images
+        status = f"{time.strftime('%H:%M:%S')} files: {len(done)} images: {n_total} (+{n_new})"
+        if threshold_low is not None and n_total:
+            pump, probe, not_assigned = histogram.dose_point_counts
+            status += f"  pump: {pump} ({100 * pump / n_total:.1f} %)  probe: {probe} ({100 * probe / n_total:.1f} %)"
+            if not_assigned:
+                status += f"  not assigned: {not_assigned}"
+        print(status, flush=True)
+        if threshold_low is None and n_new:
+            try:
+                print_suggestion(suggest_threshold(np.concatenate(histogram.values)))
+            except ValueError as e:
+                print(f"Threshold not suggested: {e}")
+        if once:
+            return histogram
+        time.sleep(period)
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="pppp - X-ray Pump and Probe Processing Pipeline - follow the cheetah directory and calculate average total scattered intensity of new images"
+    )
+    parser.add_argument(
+        "--dir", "--path",
+        help="Absolute path to the directory with data",
+        type=str,
+        required=True,
+        dest="path"
+    )
+    parser.add_argument(
+        "--files",
+        help="Names of runs or files to be followed (default: all)",
+        type=str,
+        nargs="+"
+    )
+    parser.add_argument(
+        "--geom",
+        help="Absolute path to a geometry file for DIALS or xia2",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="Threshold that divides pump and probe data - report numbers of pump and probe images (default: a threshold is suggested from the images so far)",
+        nargs='+',
+        metavar=('threshold_low', 'threshold_high'),
+    )
+    parser.add_argument(
+        "--dataset",
+        help=f"Dataset with the frames (default: {H5_DATASET})",
+        type=str,
+        default=H5_DATASET,
+    )
+    parser.add_argument(
+        "--period",
+        help="Seconds between checks for new data (default: 30)",
+        type=float,
+        default=30,
+    )
+    parser.add_argument(
+        "--once",
+        help="Process the data available now and exit",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bands",
+        help="Resolution (A) edges of bands, e.g. 20 6 3 - mean intensity in every band and the ratio of the first and the last band are calculated as well",
+        type=float,
+        nargs="+",
+    )
+    parser.add_argument(
+        "--bright",
+        help="Count also pixels with this value or higher in every image",
+        type=float,
+    )
+    parser.add_argument(
+        "--profile-bins",
+        help="Save also the radial profile of every image averaged to this number of bins",
+        type=int,
+        default=0,
+        dest="profile_bins",
+    )
+    args = parser.parse_args()
+
+    threshold_low = None
+    threshold_high = None
+    if args.threshold:
+        if len(args.threshold) > 2:
+            sys.exit('Argument --threshold takes one or two values')
+        threshold_low = args.threshold[0]
+        threshold_high = args.threshold[-1]
+    try:
+        features = feature_config(args.bands, args.bright, args.profile_bins)
+    except ValueError as e:
+        sys.exit(str(e))
+    if args.path[-1] == "/":
+        args.path = args.path[:-1]
+
+    print("PPPP Pump & Probe Processing Pipeline - live mode")
+    print(f"Working directory: {os.getcwd()}")
+    print(f"Following {args.path} - stop using Ctrl+C")
+    print("")
+    try:
+        watch(args.path, args.geom, args.files, threshold_low, threshold_high, args.period, args.dataset, args.once,
+              features)
+    except KeyboardInterrupt:
+        print("")
+    print("Histogram of average intensities saved in average_intensity_live_histogram.csv")
+    print("Done.")
+
+
+if __name__ == "__main__":
+    run()